@@ -0,0 +1,241 @@
+import asyncio
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import tiktoken
+from discord import Object, Permissions, TextChannel, utils
+
+from src import metrics
+from src.config import AIConfig
+from src.discord_client import DiscordClient
+from src.summarizer import Summarizer
+
+SYLLABLES = ["ba", "ko", "ri", "tem", "lo", "sha", "nu", "dex", "pa", "vin", "qui"]
+
+# Splits text into pieces before encoding, as tiktoken's GPT-2 encoding does.
+PAT_STR = (
+    r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+)
+
+
+def make_vocabulary(size: int, rng: random.Random) -> List[str]:
+    """
+    Returns size distinct made up words of up to three syllables.
+    """
+    assert size <= sum(len(SYLLABLES) ** k for k in range(1, 4))
+    words: set[str] = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(1, 3))))
+    return sorted(words)
+
+
+def make_encoding(words: List[str]) -> tiktoken.Encoding:
+    """
+    Returns a BPE encoding in which each of words, with or without a leading space, is one token
+    and all other text is a token per byte. Unlike real encodings, this needs no download.
+    """
+    ranks = {bytes([i]): i for i in range(256)}
+    for word in words:
+        for text in (word, f" {word}"):
+            encoded = text.encode()
+            # BPE merges pairs, so every prefix of a token must also be a token.
+            for end in range(2, len(encoded) + 1):
+                ranks.setdefault(encoded[:end], len(ranks))
+    return tiktoken.Encoding(
+        name="bench", pat_str=PAT_STR, mergeable_ranks=ranks, special_tokens={}
+    )
+
+
+@dataclass
+class FakeUser:
+    name: str
+
+
+@dataclass
+class FakeMessage:
+    author: FakeUser
+    content: str
+    created_at: datetime
+    id: int
+    edited_at: Optional[datetime] = None
+
+
+class FakeChannel(TextChannel):
+    """
+    A text channel whose history is held in memory and fetched a page at a time, each page taking
+    page_latency seconds, as from Discord.
+    """
+
+    def __init__(
+        self,
+        id: int,
+        name: str,
+        messages: List[FakeMessage],
+        page_latency: float,
+    ):
+        self.id = id
+        self.name = name
+        self.messages = messages
+        self.last_message_id = messages[-1].id if messages else None
+        self.page_latency = page_latency
+        self.pages_fetched = 0
+        self.sent: List[str] = []
+
+    def permissions_for(self, obj: Any, /) -> Permissions:
+        return Permissions(read_messages=True)
+
+    async def history(  # type: ignore[override]
+        self,
+        *,
+        limit: Optional[int] = 100,
+        before: Any = None,
+        after: Any = None,
+        around: Any = None,
+        oldest_first: Optional[bool] = None,
+    ) -> AsyncIterator[Any]:
+        after_id = snowflake(after) if after is not None else 0
+        before_id = snowflake(before) if before is not None else None
+        messages = [
+            msg
+            for msg in self.messages
+            if msg.id > after_id and (before_id is None or msg.id < before_id)
+        ]
+        # As with Discord, messages are returned oldest first only when after is given.
+        if after is None:
+            messages.reverse()
+        if limit is not None:
+            messages = messages[:limit]
+        for start in range(0, len(messages), 100):
+            await asyncio.sleep(self.page_latency)
+            self.pages_fetched += 1
+            for msg in messages[start : start + 100]:
+                yield msg
+
+    async def send(self, content: Any = None, **kwargs: Any) -> Any:  # type: ignore[override]
+        self.sent.append(str(content))
+
+
+def snowflake(value: Any) -> int:
+    if isinstance(value, datetime):
+        return utils.time_snowflake(value)
+    assert isinstance(value, Object)
+    return value.id
+
+
+class FakeGuild:
+    def __init__(self, id: int, channels: List[FakeChannel]):
+        self.id = id
+        self.channels = channels
+        self.me = FakeUser("bench")
+
+    @property
+    def text_channels(self) -> List[FakeChannel]:
+        return self.channels
+
+
+def make_guild(
+    num_channels: int,
+    messages_per_hour: float,
+    hours: float,
+    message_words: int,
+    page_latency: float,
+    words: List[str],
+    rng: random.Random,
+    output_channel_id: int,
+) -> FakeGuild:
+    """
+    Returns a guild with num_channels channels, each with messages sent at random times over the
+    last hours hours at an average of messages_per_hour, plus an empty output channel.
+    """
+    now = datetime.now(timezone.utc)
+    authors = [FakeUser(f"user{i}") for i in range(50)]
+    channels = []
+    for c in range(num_channels):
+        num_messages = int(messages_per_hour * hours)
+        times = sorted(
+            now - timedelta(hours=rng.uniform(0, hours)) for _ in range(num_messages)
+        )
+        messages = [
+            FakeMessage(
+                rng.choice(authors),
+                " ".join(
+                    rng.choices(
+                        words, k=max(1, int(rng.expovariate(1 / message_words)))
+                    )
+                ),
+                created_at,
+                # Snowflakes are unique even for messages sent in the same millisecond.
+                utils.time_snowflake(created_at) + i,
+            )
+            for i, created_at in enumerate(times)
+        ]
+        channels.append(FakeChannel(1000 + c, f"channel-{c}", messages, page_latency))
+    channels.append(FakeChannel(output_channel_id, "summaries", [], page_latency))
+    return FakeGuild(1, channels)
+
+
+class BenchClient(DiscordClient):
+    """
+    A DiscordClient that is logged in to guild without connecting to Discord.
+    """
+
+    def __init__(self, guild: FakeGuild, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.guild = guild
+        self._connection.application_id = 1
+
+    def get_guild(self, id: int, /) -> Any:
+        return self.guild if id == self.guild.id else None
+
+
+class StubSummarizer(Summarizer):
+    """
+    Summarizes without an AI provider. Each request takes latency seconds, plus the time to produce
+    max_output_tokens at tokens_per_second.
+    """
+
+    def __init__(
+        self,
+        config: AIConfig,
+        encoding: tiktoken.Encoding,
+        max_msg_tokens: int,
+        latency: float,
+        tokens_per_second: float,
+        words: List[str],
+    ):
+        Summarizer.__init__(self, config)
+        self.encoding = encoding
+        self.max_msg_tokens = max_msg_tokens
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.summary = " ".join(words[: config.max_output_tokens])
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.prompt_tokens: Dict[str, int] = {}
+
+    async def summarize(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> str:
+        prompt = prompt or self.config.prompt
+        if prompt not in self.prompt_tokens:
+            self.prompt_tokens[prompt] = len(self.encoding.encode_ordinary(prompt))
+        if num_tokens is None:
+            num_tokens = len(self.encoding.encode_ordinary("".join(messages)))
+        input_tokens = num_tokens + self.prompt_tokens[prompt]
+        self.calls += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += self.config.max_output_tokens
+        with metrics.timed("llm"):
+            await asyncio.sleep(
+                self.latency + self.config.max_output_tokens / self.tokens_per_second
+            )
+        metrics.record_llm_request(
+            self.config.model, "ok", input_tokens, self.config.max_output_tokens
+        )
+        return self.summary
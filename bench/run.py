@@ -0,0 +1,260 @@
+"""
+Benchmarks periodic summaries and /tldr against a synthetic guild and a stub AI provider, with no
+network access. Run from the repository root with `python -m bench.run --help`.
+"""
+
+import argparse
+import asyncio
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from discord import Intents
+
+from bench.fakes import (
+    BenchClient,
+    StubSummarizer,
+    make_encoding,
+    make_guild,
+    make_vocabulary,
+)
+from src import metrics
+from src.config import (
+    DEFAULT_COMBINE_PROMPT,
+    DEFAULT_PROMPT,
+    AIConfig,
+    AIProvider,
+    DiscordClientConfig,
+    GuildConfig,
+    PreprocessStep,
+    RoutingPolicy,
+    SummaryMode,
+    WorkerMode,
+)
+
+OUTPUT_CHANNEL_ID = 1
+
+# How often to check how late the event loop is running.
+LAG_INTERVAL = 0.005
+
+
+async def measure_lag(lags: List[float]) -> None:
+    """
+    Records how much later than requested each short sleep wakes up, i.e. how long the event loop
+    was blocked.
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "scenario",
+        choices=["periodic", "tldr"],
+        help="periodic summarizes every channel, tldr summarizes one channel per request",
+    )
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument(
+        "--messages-per-hour", type=float, default=50, help="per channel"
+    )
+    parser.add_argument(
+        "--hours", type=float, default=24, help="period of history to summarize"
+    )
+    parser.add_argument(
+        "--message-words", type=int, default=12, help="mean words per message"
+    )
+    parser.add_argument(
+        "--tldr-requests", type=int, default=1, help="concurrent /tldr requests"
+    )
+    parser.add_argument(
+        "--page-latency",
+        type=float,
+        default=0.1,
+        help="seconds per page of channel history",
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=1.0, help="seconds per AI request"
+    )
+    parser.add_argument(
+        "--llm-tokens-per-second",
+        type=float,
+        default=80,
+        help="AI output tokens per second",
+    )
+    parser.add_argument("--max-msg-tokens", type=int, default=15000)
+    parser.add_argument("--max-output-tokens", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--mode", choices=[m.value for m in SummaryMode], default="batches"
+    )
+    parser.add_argument(
+        "--preprocess", default="", help="comma separated, as PREPROCESS"
+    )
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--embeds", action="store_true", help="as OUTPUT_EMBEDS")
+    parser.add_argument(
+        "--send-interval",
+        type=float,
+        default=0,
+        help="as OUTPUT_SEND_INTERVAL, seconds between messages posted",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="report peak Python memory with tracemalloc, which slows everything down",
+    )
+    parser.add_argument("--output", help="also append the report to this file")
+    return parser.parse_args()
+
+
+async def run(args: argparse.Namespace) -> List[str]:
+    rng = random.Random(args.seed)
+    words = make_vocabulary(1000, rng)
+    encoding = make_encoding(words)
+    setup_start = time.perf_counter()
+    guild = make_guild(
+        args.channels,
+        args.messages_per_hour,
+        args.hours,
+        args.message_words,
+        args.page_latency,
+        words,
+        rng,
+        OUTPUT_CHANNEL_ID,
+    )
+    ai_config = AIConfig(
+        prompt=DEFAULT_PROMPT,
+        combine_prompt=DEFAULT_COMBINE_PROMPT,
+        max_output_tokens=args.max_output_tokens,
+        provider=AIProvider.open_ai,
+        model="bench",
+        api_key="",
+        models=["bench"],
+        routing_policy=RoutingPolicy.fixed,
+        model_registry_path=None,
+        summary_cache_size=0,
+        summary_cache_ttl=None,
+        summary_cache_path=None,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        worker_rate_limit_share=0.5,
+        batch_api=None,
+        batch_api_path="",
+        batch_api_poll_interval=0,
+    )
+    summarizer = StubSummarizer(
+        ai_config,
+        encoding,
+        args.max_msg_tokens,
+        args.llm_latency,
+        args.llm_tokens_per_second,
+        words,
+    )
+    guild_config = GuildConfig(
+        guild_id=guild.id,
+        summary_output_channel_id=OUTPUT_CHANNEL_ID,
+        summary_interval=int(args.hours * 3600),
+        summary_msg_lower_limit=0,
+        summary_autostart=False,
+        authorized_user_ids=[],
+        summary_cron=None,
+        summary_schedule_path=None,
+        scheduler_state_path=None,
+    )
+    config = DiscordClientConfig(
+        guilds=[guild_config],
+        guild_concurrency=1,
+        client_key="",
+        summary_concurrency=args.concurrency,
+        message_store_path=None,
+        message_store_retention=0,
+        batch_summary_path=None,
+        batch_summary_retention=0,
+        summary_mode=SummaryMode(args.mode),
+        tldr_workers=args.tldr_requests,
+        tldr_queue_size=args.tldr_requests,
+        stream_summaries=args.stream,
+        token_cache_size=100000,
+        preprocess_steps=[
+            PreprocessStep(step) for step in args.preprocess.split(",") if step
+        ],
+        metrics_port=None,
+        output_embeds=args.embeds,
+        output_send_interval=args.send_interval,
+        command_hash_path=None,
+        worker_mode=WorkerMode.local,
+        job_queue_path="",
+    )
+    client = BenchClient(guild, config, summarizer, intents=Intents.default())
+    setup_time = time.perf_counter() - setup_start
+    since = datetime.now(timezone.utc) - timedelta(hours=args.hours)
+    output_channel = guild.channels[-1]
+
+    lags: List[float] = []
+    lag_task = asyncio.create_task(measure_lag(lags))
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with metrics.summary_run(args.scenario) as run_stats:
+        if args.scenario == "periodic":
+            await client.summarise(guild_config, since)
+        else:
+            await asyncio.gather(
+                *(
+                    client.summarise_messages(
+                        client.message_history(channel, 0),
+                        channel.id,
+                        output_channel,
+                    )
+                    for channel in guild.channels[: args.tldr_requests]
+                )
+            )
+    wall_time = time.perf_counter() - start
+    lag_task.cancel()
+
+    num_messages = sum(len(channel.messages) for channel in guild.channels)
+    report = [
+        f"scenario={args.scenario} channels={args.channels} messages={num_messages} mode={args.mode} concurrency={args.concurrency} preprocess={args.preprocess or 'none'} stream={args.stream} embeds={args.embeds}",
+        f"setup_time={setup_time:.2f}s wall_time={wall_time:.2f}s",
+        f"llm_calls={summarizer.calls} input_tokens={summarizer.input_tokens} output_tokens={summarizer.output_tokens}",
+        f"pages_fetched={sum(channel.pages_fetched for channel in guild.channels)} messages_sent={len(output_channel.sent)}",
+        # Summed over concurrent work, so may add up to more than wall_time.
+        " ".join(
+            f"{stage}={seconds:.2f}s"
+            for stage, seconds in run_stats.stage_seconds.items()
+        ),
+    ]
+    if lags:
+        report.append(
+            f"loop_lag_mean={statistics.mean(lags) * 1000:.2f}ms loop_lag_max={max(lags) * 1000:.2f}ms"
+        )
+    # ru_maxrss is in kilobytes on Linux.
+    report.append(
+        f"peak_rss={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB"
+    )
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report.append(f"peak_traced_memory={peak / 1024 / 1024:.1f}MB")
+    return report
+
+
+def main() -> None:
+    args = parse_args()
+    report = asyncio.run(run(args))
+    print("\n".join(report))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write("\n".join(report) + "\n\n")
+
+
+if __name__ == "__main__":
+    main()
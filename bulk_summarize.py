@@ -0,0 +1,68 @@
+"""
+Summarizes an archive of messages offline, writing a Markdown file of summaries per channel and day
+instead of posting to Discord. Runs can be interrupted and resumed, and re-summarize only what
+changed settings, such as the prompt or model, affect.
+"""
+
+import argparse
+import os
+from datetime import date
+
+from src.bulk import read_messages, summarize_archive, work_units
+from src.config import SummaryMode, load_ai_config, parse_preprocess_steps
+
+
+def main() -> None:
+    # Loaded first so that ENV_FILE applies to the defaults below.
+    config = load_ai_config()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "archive",
+        help="JSONL export, or SQLite database in the format of MESSAGE_STORE_PATH",
+    )
+    parser.add_argument("output", help="directory to write summaries to")
+    parser.add_argument(
+        "--processes", type=int, default=os.cpu_count() or 1, help="worker processes"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("SUMMARY_CONCURRENCY", "1")),
+        help="AI requests at once per worker process",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=[SummaryMode.batches.value, SummaryMode.channel.value],
+        default=SummaryMode.batches.value,
+        help="batches writes a summary per batch, channel combines them into one per day",
+    )
+    parser.add_argument(
+        "--preprocess",
+        default=os.getenv("PREPROCESS", ""),
+        help="comma separated, as PREPROCESS",
+    )
+    parser.add_argument(
+        "--since", type=date.fromisoformat, help="first day, YYYY-MM-DD"
+    )
+    parser.add_argument("--until", type=date.fromisoformat, help="last day, YYYY-MM-DD")
+    parser.add_argument(
+        "--channel", type=int, action="append", help="only summarize this channel id"
+    )
+    args = parser.parse_args()
+
+    units = work_units(
+        read_messages(args.archive), args.since, args.until, args.channel
+    )
+    summarize_archive(
+        config,
+        units,
+        args.output,
+        args.processes,
+        parse_preprocess_steps(args.preprocess),
+        args.concurrency,
+        SummaryMode(args.mode),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import abc
+import asyncio
+import json
+import os
+import uuid
+from typing import AsyncIterator, Dict, List, Literal, Optional
+
+from openai import AsyncOpenAI
+
+from .openai_utils import chat_request
+from .summarizer import Summarizer
+
+BATCH_ENDPOINT: Literal["/v1/chat/completions"] = "/v1/chat/completions"
+
+# Statuses of OpenAI batch jobs that have not finished yet.
+PENDING_STATUSES = {"validating", "in_progress", "finalizing", "cancelling"}
+
+
+class BatchBackend(abc.ABC):
+    """
+    Runs jobs made up of many chat completion requests, in the format of the OpenAI Batch API.
+    """
+
+    @abc.abstractmethod
+    async def submit(self, job_file: str) -> str:
+        """
+        Submits the requests in the JSONL file at job_file and returns the id of the job.
+        """
+        pass
+
+    @abc.abstractmethod
+    async def results(self, job_id: str) -> Optional[List[dict]]:
+        """
+        Returns the results of the job, or None if it has not finished. Once the job has finished,
+        its files are deleted.
+        """
+        pass
+
+
+class OpenAIBatchBackend(BatchBackend):
+    def __init__(self, client: AsyncOpenAI):
+        self.client = client
+
+    async def submit(self, job_file: str) -> str:
+        with open(job_file, "rb") as f:
+            file = await self.client.files.create(file=f, purpose="batch")
+        batch = await self.client.batches.create(
+            completion_window="24h", endpoint=BATCH_ENDPOINT, input_file_id=file.id
+        )
+        return batch.id
+
+    async def results(self, job_id: str) -> Optional[List[dict]]:
+        batch = await self.client.batches.retrieve(job_id)
+        if batch.status in PENDING_STATUSES:
+            return None
+        try:
+            if batch.status != "completed" or batch.output_file_id is None:
+                raise Exception(f"Batch job {job_id} did not complete: {batch.status}")
+            content = await self.client.files.content(batch.output_file_id)
+            return [json.loads(line) for line in content.text.splitlines() if line]
+        finally:
+            await self._delete_files(
+                [batch.input_file_id, batch.output_file_id, batch.error_file_id]
+            )
+
+    async def _delete_files(self, file_ids: List[Optional[str]]) -> None:
+        for file_id in file_ids:
+            if file_id is None:
+                continue
+            try:
+                await self.client.files.delete(file_id)
+            except Exception as e:
+                # The results are still good, and the file expires eventually.
+                print(f"Failed to delete batch file file_id={file_id}: {e!r}")
+
+
+class LocalBatchBackend(BatchBackend):
+    """
+    A stand-in for the OpenAI Batch API, for testing. Jobs are completed in the background by
+    summarizer, one request at a time, and their results are written next to the job file in the
+    same format as the Batch API's output files.
+    """
+
+    def __init__(self, summarizer: Summarizer):
+        self.summarizer = summarizer
+        self.job_files: Dict[str, str] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    async def submit(self, job_file: str) -> str:
+        job_id = f"local-{uuid.uuid4().hex}"
+        # Read now, as for an upload, since the job file may be deleted once submitted.
+        with open(job_file) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        self.job_files[job_id] = job_file
+        self.tasks[job_id] = asyncio.create_task(self._run(job_file, requests))
+        return job_id
+
+    async def results(self, job_id: str) -> Optional[List[dict]]:
+        if not self.tasks[job_id].done():
+            return None
+        output_file = self._output_file(self.job_files.pop(job_id))
+        try:
+            # Raises if the job failed.
+            self.tasks.pop(job_id).result()
+            with open(output_file) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        finally:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+
+    async def _run(self, job_file: str, requests: List[dict]) -> None:
+        with open(self._output_file(job_file), "w") as f:
+            for request in requests:
+                system, user = request["body"]["messages"]
+                summary = await self.summarizer.summarize(
+                    [user["content"]], system["content"]
+                )
+                result = {
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"content": summary}}]},
+                    },
+                    "error": None,
+                }
+                f.write(json.dumps(result) + "\n")
+
+    def _output_file(self, job_file: str) -> str:
+        return f"{os.path.splitext(job_file)[0]}.output.jsonl"
+
+
+class BatchJobSummarizer(Summarizer):
+    """
+    Wraps a Summarizer so that summarize_many sends its requests together as one batch job, which
+    costs less but may take hours to complete. Other requests go to the wrapped Summarizer.
+    """
+
+    def __init__(
+        self,
+        summarizer: Summarizer,
+        backend: BatchBackend,
+        job_dir: str,
+        poll_interval: float = 60.0,
+    ):
+        Summarizer.__init__(self, summarizer.config)
+        self.summarizer = summarizer
+        self.encoding = summarizer.encoding
+        self.max_msg_tokens = summarizer.max_msg_tokens
+        self.backend = backend
+        self.job_dir = job_dir
+        self.poll_interval = poll_interval
+
+    async def summarize(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> str:
+        return await self.summarizer.summarize(messages, prompt, num_tokens)
+
+    def model_for(self, messages: List[str], num_tokens: Optional[int] = None) -> str:
+        return self.summarizer.model_for(messages, num_tokens)
+
+    async def summarize_stream(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        async for piece in self.summarizer.summarize_stream(
+            messages, prompt, num_tokens
+        ):
+            yield piece
+
+    async def summarize_many(
+        self,
+        requests: List[List[str]],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[List[int]] = None,
+    ) -> List[str]:
+        # Each batch job may only use one model, so send a job per model.
+        jobs: Dict[str, Dict[int, dict]] = {}
+        for i, messages in enumerate(requests):
+            model = self.summarizer.model_for(
+                messages, num_tokens[i] if num_tokens else None
+            )
+            jobs.setdefault(model, {})[i] = chat_request(
+                self.config, messages, prompt, model
+            )
+        summaries: Dict[int, str] = {}
+        for job_summaries in await asyncio.gather(
+            *(self._run_job(bodies) for bodies in jobs.values())
+        ):
+            summaries.update(job_summaries)
+        return [summaries[i] for i in range(len(requests))]
+
+    async def _run_job(self, bodies: Dict[int, dict]) -> Dict[int, str]:
+        """
+        Runs a batch job of the chat completion request bodies, returning the summary for each key.
+        """
+        os.makedirs(self.job_dir, exist_ok=True)
+        job_file = os.path.join(self.job_dir, f"{uuid.uuid4().hex}.jsonl")
+        with open(job_file, "w") as f:
+            for i, body in bodies.items():
+                request = {
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": body,
+                }
+                f.write(json.dumps(request) + "\n")
+        try:
+            job_id = await self.backend.submit(job_file)
+        finally:
+            # The backend has its own copy of the requests once submitted.
+            os.remove(job_file)
+        print(f"Submitted batch job job_id={job_id} requests={len(bodies)}")
+        while (results := await self.backend.results(job_id)) is None:
+            await asyncio.sleep(self.poll_interval)
+        print(f"Batch job complete job_id={job_id}")
+        # Results are not necessarily in the same order as the requests.
+        by_id = {result["custom_id"]: result for result in results}
+        summaries = {}
+        for i in bodies:
+            result = by_id.get(str(i))
+            if (
+                result is None
+                or result.get("error")
+                or result["response"]["status_code"] != 200
+            ):
+                raise Exception(f"Batch job {job_id} request {i} failed: {result}")
+            summaries[i] = result["response"]["body"]["choices"][0]["message"][
+                "content"
+            ]
+        return summaries
@@ -0,0 +1,102 @@
+import sqlite3
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass
+class BatchSummary:
+    first_id: int
+    last_id: int
+    next_id: int
+    summary: str
+
+
+class BatchSummaryStore:
+    """
+    Remembers the boundaries and summaries of full batches, per channel, so that a later summary of
+    an overlapping range of messages can reuse them and only summarize messages sent since.
+
+    Summaries are stored with the fingerprint of the settings they were made with, and only reused
+    while the settings are unchanged.
+    """
+
+    def __init__(self, fingerprint: str, path: str = ":memory:"):
+        self.fingerprint = fingerprint
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batch_summaries (
+                channel_id INTEGER NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                next_id INTEGER NOT NULL,
+                summary TEXT NOT NULL,
+                fingerprint TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (channel_id, first_id)
+            )
+            """
+        )
+        columns = {
+            row[1] for row in self.db.execute("PRAGMA table_info(batch_summaries)")
+        }
+        if "fingerprint" not in columns:
+            # Summaries stored before fingerprints were added are never reused.
+            self.db.execute(
+                "ALTER TABLE batch_summaries ADD COLUMN fingerprint TEXT NOT NULL DEFAULT ''"
+            )
+
+    def add(self, channel_id: int, batch_summary: BatchSummary) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO batch_summaries VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    channel_id,
+                    batch_summary.first_id,
+                    batch_summary.last_id,
+                    batch_summary.next_id,
+                    batch_summary.summary,
+                    self.fingerprint,
+                ),
+            )
+
+    def chain(self, channel_id: int, first_id: int) -> List[BatchSummary]:
+        """
+        Returns the consecutive batch summaries that start at message first_id, made with the
+        current settings.
+        """
+        chain: List[BatchSummary] = []
+        while (
+            (
+                row := self.db.execute(
+                    """
+                SELECT first_id, last_id, next_id, summary FROM batch_summaries
+                WHERE channel_id = ? AND first_id = ? AND fingerprint = ?
+                """,
+                    (channel_id, first_id, self.fingerprint),
+                ).fetchone()
+            )
+            is not None
+        ):
+            chain.append(BatchSummary(*row))
+            first_id = row[2]
+        return chain
+
+    def invalidate(self, channel_id: int, message_id: int) -> None:
+        """
+        Forgets summaries of batches containing message_id, e.g. because it was edited or deleted.
+        Batches span up to the next batch's first message, as preprocessing may merge messages.
+        """
+        with self.db:
+            self.db.execute(
+                """
+                DELETE FROM batch_summaries
+                WHERE channel_id = ? AND first_id <= ? AND next_id > ?
+                """,
+                (channel_id, message_id, message_id),
+            )
+
+    def prune(self, before_id: int) -> None:
+        with self.db:
+            self.db.execute(
+                "DELETE FROM batch_summaries WHERE first_id < ?", (before_id,)
+            )
@@ -0,0 +1,131 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import tiktoken
+
+from .messages import ChannelMessage, MessageFormatter
+
+
+@dataclass
+class Batch:
+    messages: List[str] = field(default_factory=list)
+    num_tokens: int = 0
+    # Ids of the first and last messages in the batch.
+    first_id: int = 0
+    last_id: int = 0
+    # Id of the message that starts the following batch. Only set once the batch is full, at which
+    # point its contents no longer depend on later messages.
+    next_id: Optional[int] = None
+
+
+class MessageBatcher:
+    """
+    Packs formatted messages into batches of at most max_tokens tokens, preserving message order.
+    Messages are counted before they are added, e.g. by a TokenCounter, so the batcher only
+    tokenizes batch headers.
+    """
+
+    def __init__(
+        self,
+        encoding: tiktoken.Encoding,
+        max_tokens: int,
+        formatter: MessageFormatter = MessageFormatter(),
+    ):
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+        self.formatter = formatter
+        self._batch = Batch()
+        # Used to build the batch's header once it is complete.
+        self._first_msg: Optional[ChannelMessage] = None
+        self._authors: dict[str, None] = {}
+        self._author_entry_tokens: dict[str, int] = {}
+        # Channel id -> tokens in the header of a batch of the channel's messages, without authors.
+        self._base_header_counts: dict[int, int] = {}
+
+    def add_counted(
+        self,
+        messages: List[ChannelMessage],
+        formatted_msgs: List[str],
+        msg_tokens: List[int],
+    ) -> List[Batch]:
+        """
+        Adds messages, already formatted as formatted_msgs and counted as msg_tokens tokens each, to
+        the current batch, returning any batches that were filled in the process.
+        """
+        completed: List[Batch] = []
+        for msg, formatted_msg, num_tokens in zip(messages, formatted_msgs, msg_tokens):
+            # A message must fit in a batch of its own, along with the batch's header.
+            alone_tokens = (
+                self._base_header_tokens(msg)
+                + self._author_entry_count(msg.author)
+                + num_tokens
+            )
+            # Edge case: need to handle this somehow
+            if alone_tokens > self.max_tokens:
+                raise Exception(
+                    f"Message too long to process: channel={msg.channel.name} num_tokens={num_tokens}"
+                )
+            if self._first_msg is None:
+                added_tokens = alone_tokens
+            else:
+                added_tokens = self._header_tokens(msg) + num_tokens
+            if self._batch.num_tokens + added_tokens > self.max_tokens and (
+                batch := self._complete_batch()
+            ):
+                batch.next_id = msg.id
+                completed.append(batch)
+                added_tokens = alone_tokens
+            if self._first_msg is None:
+                self._first_msg = msg
+                self._batch.first_id = msg.id
+            self._batch.num_tokens += added_tokens
+            self._authors[msg.author] = None
+            self._batch.messages.append(formatted_msg)
+            self._batch.last_id = msg.id
+        return completed
+
+    def flush(self) -> Optional[Batch]:
+        """
+        Returns the final, partially filled batch, if any.
+        """
+        return self._complete_batch()
+
+    def _complete_batch(self) -> Optional[Batch]:
+        batch, self._batch = self._batch, Batch()
+        first_msg, self._first_msg = self._first_msg, None
+        authors, self._authors = list(self._authors), {}
+        if first_msg is None:
+            return None
+        if header := self.formatter.header(first_msg, authors):
+            batch.messages.insert(0, header)
+        return batch
+
+    def _header_tokens(self, msg: ChannelMessage) -> int:
+        """
+        Tokens that msg would add to the current batch's header, once the batch has a first message.
+        """
+        if msg.author in self._authors:
+            return 0
+        return self._author_entry_count(msg.author)
+
+    def _base_header_tokens(self, first_msg: ChannelMessage) -> int:
+        """
+        Tokens in the header of a batch starting with first_msg, before any author entries.
+        """
+        # The header only depends on the first message's channel, and not its contents.
+        channel_id = first_msg.channel.id
+        if channel_id not in self._base_header_counts:
+            self._base_header_counts[channel_id] = self._count(
+                self.formatter.header(first_msg, [])
+            )
+        return self._base_header_counts[channel_id]
+
+    def _author_entry_count(self, author: str) -> int:
+        if author not in self._author_entry_tokens:
+            self._author_entry_tokens[author] = self._count(
+                self.formatter.author_entry(author)
+            )
+        return self._author_entry_tokens[author]
+
+    def _count(self, text: str) -> int:
+        return len(self.encoding.encode_ordinary(text)) if text else 0
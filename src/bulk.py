@@ -0,0 +1,236 @@
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from .config import AIConfig, PreprocessStep, SummaryMode
+from .messages import ChannelInfo, ChannelMessage, message_from_dict
+from .pipeline import SummaryPipeline
+from .rate_limiter import scaled_limit
+from .summarizer import Summarizer, fingerprint
+from .worker_queue import worker_summarizer
+
+CHECKPOINT_FILE = "checkpoint.jsonl"
+
+
+@dataclass
+class WorkUnit:
+    """
+    The messages sent in one channel on one day (UTC), summarized together.
+    """
+
+    channel: ChannelInfo
+    day: date
+    messages: List[ChannelMessage]
+
+    @property
+    def key(self) -> str:
+        return f"{self.channel.id}/{self.day.isoformat()}"
+
+
+def read_jsonl(path: str) -> Iterator[ChannelMessage]:
+    """
+    Reads messages from a JSONL file with one message per line, with the same fields as the message
+    store. Times may be ISO 8601 strings or Unix timestamps.
+    """
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            yield message_from_dict(json.loads(line))
+
+
+def read_sqlite(path: str) -> Iterator[ChannelMessage]:
+    """
+    Reads messages from a SQLite database in the format of the message store.
+    """
+    db = sqlite3.connect(path)
+    try:
+        for row in db.execute(
+            "SELECT id, channel_id, channel_name, author, content, created_at, edited_at FROM messages ORDER BY channel_id, id"
+        ):
+            yield ChannelMessage(
+                row[3],
+                row[4],
+                ChannelInfo(row[2], row[1]),
+                datetime.fromtimestamp(row[5], timezone.utc),
+                row[0],
+                datetime.fromtimestamp(row[6], timezone.utc) if row[6] else None,
+            )
+    finally:
+        db.close()
+
+
+def read_messages(path: str) -> Iterator[ChannelMessage]:
+    if path.endswith((".jsonl", ".json")):
+        return read_jsonl(path)
+    return read_sqlite(path)
+
+
+def work_units(
+    messages: Iterator[ChannelMessage],
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    channel_ids: Optional[List[int]] = None,
+) -> List[WorkUnit]:
+    """
+    Groups messages by channel and day, from since up to and including until.
+    """
+    units: Dict[tuple[int, date], WorkUnit] = {}
+    for msg in messages:
+        day = msg.timestamp.astimezone(timezone.utc).date()
+        if (
+            (since is not None and day < since)
+            or (until is not None and day > until)
+            or (channel_ids is not None and msg.channel.id not in channel_ids)
+        ):
+            continue
+        if (msg.channel.id, day) not in units:
+            units[msg.channel.id, day] = WorkUnit(msg.channel, day, [])
+        units[msg.channel.id, day].messages.append(msg)
+    for unit in units.values():
+        unit.messages.sort(key=lambda msg: msg.id)
+    return sorted(units.values(), key=lambda unit: (unit.channel.id, unit.day))
+
+
+class Checkpoint:
+    """
+    Records which units have been summarized, and with which settings, in an append-only file so
+    that an interrupted run can be resumed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    # The last line may be incomplete if the process was killed.
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.done[entry["unit"]] = entry["fingerprint"]
+
+    def is_done(self, unit: WorkUnit, fingerprint: str) -> bool:
+        return self.done.get(unit.key) == fingerprint
+
+    def mark_done(self, unit: WorkUnit, fingerprint: str) -> None:
+        self.done[unit.key] = fingerprint
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"unit": unit.key, "fingerprint": fingerprint}) + "\n")
+
+
+def output_path(output_dir: str, unit: WorkUnit) -> str:
+    return os.path.join(
+        output_dir,
+        f"{unit.channel.name}-{unit.channel.id}",
+        f"{unit.day.isoformat()}.md",
+    )
+
+
+def write_summaries(output_dir: str, unit: WorkUnit, summaries: List[str]) -> None:
+    path = output_path(output_dir, unit)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that a partly written file is never left behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(f"# #{unit.channel.name} {unit.day.isoformat()}\n\n")
+        f.write("\n\n".join(summaries) + "\n")
+    os.replace(tmp_path, path)
+
+
+async def summarize_unit(
+    summarizer: Summarizer,
+    unit: WorkUnit,
+    preprocess_steps: List[PreprocessStep],
+    concurrency: int,
+    mode: SummaryMode,
+) -> List[str]:
+    async def history() -> AsyncIterator[ChannelMessage]:
+        for msg in unit.messages:
+            yield msg
+
+    pipeline = SummaryPipeline(
+        summarizer, concurrency=concurrency, preprocess_steps=preprocess_steps
+    )
+    summaries = [summary async for summary in pipeline.summaries(history())]
+    if mode is not SummaryMode.batches and len(summaries) > 1:
+        summaries = [await summarizer.combine(summaries)]
+    return summaries
+
+
+# Each worker process has its own summarizer and event loop, which are reused for every unit it
+# summarizes.
+_summarizer: Optional[Summarizer] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _init_worker(config: AIConfig, processes: int) -> None:
+    global _summarizer, _loop
+    _loop = asyncio.new_event_loop()
+    _summarizer = worker_summarizer(config)
+    # The processes split the rate limits evenly.
+    _summarizer.set_limits(
+        scaled_limit(config.requests_per_minute, 1 / processes),
+        scaled_limit(config.tokens_per_minute, 1 / processes),
+    )
+
+
+def _summarize_in_worker(
+    unit: WorkUnit,
+    preprocess_steps: List[PreprocessStep],
+    concurrency: int,
+    mode: SummaryMode,
+) -> List[str]:
+    assert _summarizer is not None and _loop is not None
+    return _loop.run_until_complete(
+        summarize_unit(_summarizer, unit, preprocess_steps, concurrency, mode)
+    )
+
+
+def summarize_archive(
+    config: AIConfig,
+    units: List[WorkUnit],
+    output_dir: str,
+    processes: int,
+    preprocess_steps: List[PreprocessStep],
+    concurrency: int,
+    mode: SummaryMode,
+) -> None:
+    """
+    Summarizes each unit in parallel across processes, writing summaries to a Markdown file per
+    channel and day in output_dir. Units already summarized with the same settings are skipped.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(output_dir, CHECKPOINT_FILE))
+    settings = fingerprint(config, preprocess_steps, mode)
+    todo = [unit for unit in units if not checkpoint.is_done(unit, settings)]
+    print(f"Summarizing units={len(todo)} skipped={len(units) - len(todo)}")
+    failed = 0
+    with ProcessPoolExecutor(
+        processes, initializer=_init_worker, initargs=(config, processes)
+    ) as executor:
+        futures = {
+            executor.submit(
+                _summarize_in_worker, unit, preprocess_steps, concurrency, mode
+            ): unit
+            for unit in todo
+        }
+        for i, future in enumerate(as_completed(futures)):
+            unit = futures[future]
+            try:
+                summaries = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed unit={unit.key}: {e!r}")
+                continue
+            write_summaries(output_dir, unit, summaries)
+            checkpoint.mark_done(unit, settings)
+            print(f"Summarized unit={unit.key} ({i + 1}/{len(todo)})")
+    if failed:
+        raise Exception(f"{failed} units failed. Run again to retry them.")
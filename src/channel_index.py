@@ -0,0 +1,92 @@
+from bisect import bisect_right
+from collections import defaultdict
+from typing import Iterable, List, Optional
+
+from discord import Member, TextChannel, utils
+
+# Number of message ids kept per channel. Counts only decide whether a channel has fewer messages
+# than SUMMARY_MSG_LOWER_LIMIT, so a channel with more messages than this need not be counted.
+MAX_TRACKED_MESSAGES = 1000
+
+
+class ChannelIndex:
+    """
+    Tracks channel activity and the bot's permissions from gateway events, so that periodic
+    summaries can skip channels without making any Discord API calls.
+
+    Message ids are only known for messages sent while the bot has been connected, so message
+    counts are only available for periods that started after self.observed_from, and after any
+    messages the channel's count has forgotten. Deleted messages are still counted, so counts are
+    upper bounds.
+    """
+
+    def __init__(self) -> None:
+        self.observed_from: Optional[int] = None
+        # Channel id -> ids of messages sent since self.observed_from, in ascending order.
+        self.message_ids: defaultdict[int, List[int]] = defaultdict(list)
+        # Channel id -> snowflake up to which the channel's message ids have been forgotten.
+        self.forgotten_to: dict[int, int] = {}
+        # Channel id -> whether the bot can read the channel.
+        self.readable: dict[int, bool] = {}
+
+    def reset(self) -> None:
+        """
+        Starts observing from now, e.g. after connecting to the gateway, when events may have been
+        missed.
+        """
+        self.observed_from = utils.time_snowflake(utils.utcnow())
+        self.message_ids.clear()
+        self.forgotten_to.clear()
+        self.readable.clear()
+
+    def add_message(self, channel_id: int, message_id: int) -> None:
+        message_ids = self.message_ids[channel_id]
+        message_ids.append(message_id)
+        # Channels that are never summarized are never pruned, so forget the oldest ids once there
+        # are twice as many as needed, which keeps adding messages amortized O(1).
+        if len(message_ids) > 2 * MAX_TRACKED_MESSAGES:
+            self._forget(channel_id, message_ids[-MAX_TRACKED_MESSAGES - 1])
+
+    def invalidate_permissions(self) -> None:
+        self.readable.clear()
+
+    def can_read(self, channel: TextChannel, bot_member: Member) -> bool:
+        if channel.id not in self.readable:
+            self.readable[channel.id] = channel.permissions_for(
+                bot_member
+            ).read_messages
+        return self.readable[channel.id]
+
+    def max_messages_since(self, channel: TextChannel, since_id: int) -> Optional[int]:
+        """
+        Returns an upper bound on the number of messages sent in channel after the snowflake
+        since_id, or None if it is not known.
+        """
+        # Discord keeps channel.last_message_id up to date from gateway events.
+        if channel.last_message_id is None or channel.last_message_id <= since_id:
+            return 0
+        if (
+            self.observed_from is None
+            or since_id < self.observed_from
+            or since_id < self.forgotten_to.get(channel.id, 0)
+        ):
+            return None
+        message_ids = self.message_ids[channel.id]
+        return len(message_ids) - bisect_right(message_ids, since_id)
+
+    def prune(self, before_id: int, channel_ids: Iterable[int]) -> None:
+        """
+        Forgets messages sent in channel_ids before the snowflake before_id. Only the channels
+        being summarized are pruned, as other channels, e.g. of other guilds, may be summarized
+        from earlier.
+        """
+        for channel_id in channel_ids:
+            if channel_id in self.message_ids:
+                self._forget(channel_id, before_id)
+
+    def _forget(self, channel_id: int, before_id: int) -> None:
+        message_ids = self.message_ids[channel_id]
+        del message_ids[: bisect_right(message_ids, before_id)]
+        self.forgotten_to[channel_id] = max(
+            self.forgotten_to.get(channel_id, 0), before_id
+        )
@@ -1,10 +1,13 @@
+import json
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from enum import Enum
-from typing import List
+from typing import Any, List, Optional
 
 from dotenv import load_dotenv
 
+from .schedule import CronSchedule
+
 DEFAULT_PROMPT = """
     Summarize the text using bullet points.
     MENTION NAMES EXPLICITLY AND EXACTLY AS WRITTEN IN THE MESSAGES. Be succinct but go into detail where
@@ -14,29 +17,128 @@ DEFAULT_PROMPT = """
     Typically, conversations do not span multiple channels, but that is not a hard rule.
 """
 
+DEFAULT_COMBINE_PROMPT = """
+    The text is made up of bullet point summaries of consecutive parts of Discord conversations.
+    Combine them into a single summary using bullet points, merging points about the same topic.
+    MENTION NAMES EXPLICITLY AND EXACTLY AS WRITTEN IN THE SUMMARIES. Be succinct but keep details of
+    big decisions and topics that were discussed at length.
+"""
+
+
+class SummaryMode(Enum):
+    # One summary per batch of messages.
+    batches = "batches"
+    # Batch summaries are combined into one summary per channel.
+    channel = "channel"
+    # Batch summaries are combined into one summary of the whole server.
+    server = "server"
+
+
+class WorkerMode(Enum):
+    # Periodic summaries are produced by the bot process.
+    local = "local"
+    # Periodic summaries are queued in JOB_QUEUE_PATH for separate worker processes.
+    queue = "queue"
+
+
+class PreprocessStep(Enum):
+    # Give the channel name once per batch, and timestamps relative to the first message.
+    compact = "compact"
+    # Abbreviate authors' names, listing the abbreviations once per batch. Requires compact.
+    abbreviate_authors = "abbreviate_authors"
+    # Replace URLs with their domain name.
+    urls = "urls"
+    # Replace code blocks with a placeholder.
+    code = "code"
+    # Shorten custom emoji and collapse repeated emoji.
+    emoji = "emoji"
+    # Merge consecutive messages sent by the same author within a few minutes.
+    merge = "merge"
+
 
 @dataclass
-class DiscordClientConfig:
-    summary_interval: int
+class GuildConfig:
+    """
+    Settings for summaries of one guild (Discord server).
+    """
+
+    guild_id: int
     summary_output_channel_id: int
+    summary_interval: int
     summary_msg_lower_limit: int
     summary_autostart: bool
-    guild_id: int
     authorized_user_ids: List[int]
+    summary_cron: Optional[str]
+    summary_schedule_path: Optional[str]
+    scheduler_state_path: Optional[str]
+
+
+@dataclass
+class DiscordClientConfig:
+    guilds: List[GuildConfig]
+    # How many guilds' periodic summaries may run at the same time.
+    guild_concurrency: int
     client_key: str
+    summary_concurrency: int
+    message_store_path: Optional[str]
+    message_store_retention: int
+    batch_summary_path: Optional[str]
+    batch_summary_retention: int
+    summary_mode: SummaryMode
+    tldr_workers: int
+    tldr_queue_size: int
+    stream_summaries: bool
+    token_cache_size: int
+    preprocess_steps: List[PreprocessStep]
+    metrics_port: Optional[int]
+    output_embeds: bool
+    output_send_interval: float
+    command_hash_path: Optional[str]
+    worker_mode: WorkerMode
+    job_queue_path: str
+
+
+class RoutingPolicy(Enum):
+    # Send every request to AI_MODEL.
+    fixed = "fixed"
+    # Send each request to the cheapest of AI_MODELS that fits it.
+    cheapest = "cheapest"
+    # Send each request to the fastest of AI_MODELS that fits it.
+    fastest = "fastest"
 
 
 class AIProvider(Enum):
     open_ai = "open_ai"
 
 
+class BatchAPI(Enum):
+    open_ai = "open_ai"
+    # Completes batch jobs locally with ordinary requests, for testing.
+    local = "local"
+
+
 @dataclass
 class AIConfig:
     prompt: str
+    combine_prompt: str
     max_output_tokens: int
     provider: AIProvider
     model: str
     api_key: str
+    models: List[str]
+    routing_policy: RoutingPolicy
+    model_registry_path: Optional[str]
+    summary_cache_size: int
+    summary_cache_ttl: Optional[int]
+    summary_cache_path: Optional[str]
+    requests_per_minute: Optional[int]
+    tokens_per_minute: Optional[int]
+    # Fraction of the rate limits used by worker processes when SUMMARY_WORKER_MODE is queue. The
+    # bot keeps the rest for /tldr requests.
+    worker_rate_limit_share: float
+    batch_api: Optional[BatchAPI]
+    batch_api_path: str
+    batch_api_poll_interval: int
 
 
 def load_required(name: str) -> str:
@@ -45,6 +147,92 @@ def load_required(name: str) -> str:
     return value
 
 
+def parse_preprocess_steps(value: str) -> List[PreprocessStep]:
+    """
+    Parses a comma separated list of preprocessing steps, as in PREPROCESS.
+    """
+    preprocess_steps = [PreprocessStep(step) for step in value.split(",") if step]
+    assert (
+        PreprocessStep.abbreviate_authors not in preprocess_steps
+        or PreprocessStep.compact in preprocess_steps
+    )
+    return preprocess_steps
+
+
+def load_ai_config() -> AIConfig:
+    """
+    Loads only the AI config, for tools that don't connect to Discord.
+    """
+    if ENV_FILE := os.getenv("ENV_FILE"):
+        load_dotenv(ENV_FILE)
+
+    # tiktoken otherwise caches the files it downloads in a temporary directory, which may not
+    # survive a restart.
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", "tiktoken_cache")
+
+    ai_model = load_required("AI_MODEL")
+
+    worker_rate_limit_share = float(os.getenv("WORKER_RATE_LIMIT_SHARE", "0.5"))
+    assert 0 < worker_rate_limit_share < 1
+
+    return AIConfig(
+        DEFAULT_PROMPT,
+        DEFAULT_COMBINE_PROMPT,
+        int(os.getenv("MAX_OUTPUT_TOKENS", "200")),
+        AIProvider(load_required("AI_PROVIDER")),
+        ai_model,
+        load_required("AI_API_KEY"),
+        [model for model in os.getenv("AI_MODELS", ai_model).split(",") if model],
+        RoutingPolicy(os.getenv("AI_ROUTING", "fixed")),
+        os.getenv("MODEL_REGISTRY_PATH"),
+        int(os.getenv("SUMMARY_CACHE_SIZE", "256")),
+        int(ttl) if (ttl := os.getenv("SUMMARY_CACHE_TTL")) else None,
+        os.getenv("SUMMARY_CACHE_PATH"),
+        int(rpm) if (rpm := os.getenv("AI_REQUESTS_PER_MINUTE")) else None,
+        int(tpm) if (tpm := os.getenv("AI_TOKENS_PER_MINUTE")) else None,
+        worker_rate_limit_share,
+        BatchAPI(batch_api) if (batch_api := os.getenv("BATCH_API")) else None,
+        os.getenv("BATCH_API_PATH", "batch_jobs"),
+        int(os.getenv("BATCH_API_POLL_INTERVAL", "60")),
+    )
+
+
+def load_guild_configs(path: str, defaults: dict) -> List[GuildConfig]:
+    """
+    Loads the config of each guild from the JSON file at path, a list of objects with the fields of
+    GuildConfig. guild_id and summary_output_channel_id are required, other fields default to
+    defaults.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    names = {field.name for field in fields(GuildConfig)}
+    guilds = []
+    for entry in entries:
+        if unknown := set(entry) - names:
+            raise Exception(f"Unknown guild config fields {sorted(unknown)} in {path}")
+        if "guild_id" not in entry or "summary_output_channel_id" not in entry:
+            raise Exception(
+                f"Guild config in {path} requires guild_id and summary_output_channel_id"
+            )
+        try:
+            # Discord ids are often written as strings, to avoid losing precision in JSON.
+            entry["guild_id"] = int(entry["guild_id"])
+            entry["summary_output_channel_id"] = int(entry["summary_output_channel_id"])
+            if "authorized_user_ids" in entry:
+                entry["authorized_user_ids"] = [
+                    int(user_id) for user_id in entry["authorized_user_ids"]
+                ]
+        except (TypeError, ValueError) as e:
+            raise Exception(f"Invalid id in guild config in {path}: {e}")
+        guild_defaults = dict(defaults)
+        # Each guild saves its scheduler state to its own file.
+        if state_path := defaults["scheduler_state_path"]:
+            root, ext = os.path.splitext(state_path)
+            guild_defaults["scheduler_state_path"] = f"{root}-{entry['guild_id']}{ext}"
+        guilds.append(GuildConfig(**{**guild_defaults, **entry}))
+    return guilds
+
+
 def load_config() -> tuple[DiscordClientConfig, AIConfig]:
     if ENV_FILE := os.getenv("ENV_FILE"):
         load_dotenv(ENV_FILE)
@@ -53,25 +241,76 @@ def load_config() -> tuple[DiscordClientConfig, AIConfig]:
     assert _summary_autostart in ["true", "false"]
     summary_autostart = True if _summary_autostart == "true" else False
 
+    _stream_summaries = os.getenv("STREAM_SUMMARIES", "false")
+    assert _stream_summaries in ["true", "false"]
+    stream_summaries = _stream_summaries == "true"
+
+    _output_embeds = os.getenv("OUTPUT_EMBEDS", "false")
+    assert _output_embeds in ["true", "false"]
+    output_embeds = _output_embeds == "true"
+
+    preprocess_steps = parse_preprocess_steps(os.getenv("PREPROCESS", ""))
+
+    summary_concurrency = int(os.getenv("SUMMARY_CONCURRENCY", "1"))
+    assert summary_concurrency > 0
+
+    summary_interval = int(os.getenv("SUMMARY_INTERVAL", "86400"))
+
+    # Settings for every guild, unless overridden in GUILD_CONFIG_PATH.
+    guild_defaults: dict[str, Any] = {
+        "summary_interval": summary_interval,
+        "summary_msg_lower_limit": int(os.getenv("SUMMARY_MSG_LOWER_LIMIT", "0")),
+        "summary_autostart": summary_autostart,
+        "authorized_user_ids": [
+            int(u) for u in os.getenv("AUTHORIZED_USER_IDS", "").split(",") if u != ""
+        ],
+        "summary_cron": os.getenv("SUMMARY_CRON"),
+        "scheduler_state_path": os.getenv("SCHEDULER_STATE_PATH"),
+    }
+    if guild_config_path := os.getenv("GUILD_CONFIG_PATH"):
+        # Channel schedules name channels of one guild, so are only set per guild.
+        guilds = load_guild_configs(
+            guild_config_path, {**guild_defaults, "summary_schedule_path": None}
+        )
+    else:
+        guilds = [
+            GuildConfig(
+                guild_id=int(load_required("GUILD_ID")),
+                summary_output_channel_id=int(
+                    load_required("SUMMARY_OUTPUT_CHANNEL_ID")
+                ),
+                summary_schedule_path=os.getenv("SUMMARY_SCHEDULE_PATH"),
+                **guild_defaults,
+            )
+        ]
+
+    for guild in guilds:
+        if guild.summary_cron:
+            # Raises if the expression is invalid.
+            CronSchedule(guild.summary_cron)
+
     return (
         DiscordClientConfig(
-            int(os.getenv("SUMMARY_INTERVAL", "86400")),
-            int(load_required("SUMMARY_OUTPUT_CHANNEL_ID")),
-            int(os.getenv("SUMMARY_MSG_LOWER_LIMIT", "0")),
-            summary_autostart,
-            int(load_required("GUILD_ID")),
-            [
-                int(u)
-                for u in os.getenv("AUTHORIZED_USER_IDS", "").split(",")
-                if u != ""
-            ],
+            guilds,
+            int(os.getenv("GUILD_CONCURRENCY", "1")),
             load_required("DISCORD_CLIENT_KEY"),
+            summary_concurrency,
+            os.getenv("MESSAGE_STORE_PATH"),
+            int(os.getenv("MESSAGE_STORE_RETENTION", str(summary_interval))),
+            os.getenv("BATCH_SUMMARY_PATH"),
+            int(os.getenv("BATCH_SUMMARY_RETENTION", "604800")),
+            SummaryMode(os.getenv("SUMMARY_MODE", "batches")),
+            int(os.getenv("TLDR_WORKERS", "2")),
+            int(os.getenv("TLDR_QUEUE_SIZE", "20")),
+            stream_summaries,
+            int(os.getenv("TOKEN_CACHE_SIZE", "100000")),
+            preprocess_steps,
+            int(port) if (port := os.getenv("METRICS_PORT")) else None,
+            output_embeds,
+            float(os.getenv("OUTPUT_SEND_INTERVAL", "1")),
+            os.getenv("COMMAND_HASH_PATH"),
+            WorkerMode(os.getenv("SUMMARY_WORKER_MODE", "local")),
+            os.getenv("JOB_QUEUE_PATH", "jobs.db"),
         ),
-        AIConfig(
-            DEFAULT_PROMPT,
-            int(os.getenv("MAX_OUTPUT_TOKENS", "200")),
-            AIProvider(load_required("AI_PROVIDER")),
-            load_required("AI_MODEL"),
-            load_required("AI_API_KEY"),
-        ),
+        load_ai_config(),
     )
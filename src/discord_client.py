@@ -1,271 +1,891 @@
 import asyncio
+import hashlib
+import json
+import os
 import re
-import time
-from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List
+from functools import partial
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Collection,
+    List,
+    Optional,
+    Sequence,
+)
 
 from discord import (
+    AutoShardedClient,
     ChannelType,
-    Client,
+    Guild,
     HTTPException,
     Interaction,
+    Member,
+    Message,
     NotFound,
+    Object,
+    RawBulkMessageDeleteEvent,
+    RawMessageDeleteEvent,
+    RawMessageUpdateEvent,
+    Role,
     TextChannel,
     app_commands,
     utils,
 )
+from discord.abc import GuildChannel
 
-from src.config import DiscordClientConfig
-from src.summarizer import Summarizer
+from src import metrics
+from src.batch_summaries import BatchSummary, BatchSummaryStore
+from src.batcher import Batch
+from src.channel_index import ChannelIndex
+from src.config import DiscordClientConfig, GuildConfig, SummaryMode, WorkerMode
+from src.jobs import JobQueue
+from src.live_message import LiveMessage
+from src.message_store import MessageStore
+from src.messages import ChannelInfo, ChannelMessage
+from src.output import OutputComposer, PacedSender, split_text
+from src.pipeline import DISCORD_PAGE_SIZE, SummaryPipeline
+from src.rate_limiter import Priority, request_priority
+from src.schedule import (
+    CronSchedule,
+    IntervalSchedule,
+    ScheduledSummary,
+    SummaryScheduler,
+    load_scheduled_summaries,
+)
+from src.startup import STARTUP
+from src.summarizer import Summarizer, fingerprint
+from src.token_counter import TokenCounter
+from src.worker_queue import CHANNEL_JOB, COMBINE_JOB, WorkerQueue, channel_job
 
 LINK_PATTERN = r"https://discord\.com/channels/(\d+)/(\d+)/(\d+)"
 
+# Seconds between removals of messages older than message_store_retention from the message store.
+MESSAGE_STORE_PRUNE_INTERVAL = 3600
+# Seconds between writes of the message store's buffered changes.
+MESSAGE_STORE_FLUSH_INTERVAL = 1
 
-@dataclass(frozen=True)
-class ChannelInfo:
-    name: str
-    id: int
 
+def to_channel_message(msg: Message, channel: TextChannel) -> ChannelMessage:
+    return ChannelMessage(
+        msg.author.name,
+        msg.content,
+        ChannelInfo(channel.name, channel.id),
+        msg.created_at,
+        msg.id,
+        msg.edited_at,
+    )
 
-@dataclass
-class ChannelMessage:
-    author: str
-    content: str
-    channel: ChannelInfo
-    timestamp: datetime
 
+async def channel_messages(
+    channel: TextChannel, **history_kwargs: Any
+) -> AsyncIterator[ChannelMessage]:
+    """
+    Yields messages from channel.history(**history_kwargs) as ChannelMessages, page by page.
+    """
+    async for msg in channel.history(**history_kwargs):
+        yield to_channel_message(msg, channel)
 
-def format_summary_for_discord(summary: str) -> str:
-    # Discord message size is at most 2000 characters. This crude crop may remove part of the summary.
-    return summary[:2000]
 
+class DiscordClient(AutoShardedClient):
+    """
+    Summarizes the guilds in config.guilds. Sharding splits the gateway connection across as many
+    shards as Discord recommends for the number of guilds the bot is in.
+    """
 
-class DiscordClient(Client):
     def __init__(
-        self, config: DiscordClientConfig, summarizer: Summarizer, *args, **kwargs
+        self,
+        config: DiscordClientConfig,
+        summarizer: Summarizer,
+        *args,
+        periodic_summarizer: Optional[Summarizer] = None,
+        **kwargs,
     ):
         super().__init__(*args, **kwargs)
         self.tree = app_commands.CommandTree(self)
         self.config = config
         self.summarizer = summarizer
-        self.last_summary_time = 0
-        self.summary_active = config.summary_autostart
+        # If set, all batches from a periodic summary are collected and sent to this with
+        # summarize_many, rather than summarized one at a time as they are fetched.
+        self.periodic_summarizer = periodic_summarizer
+        self.guild_configs = {guild.guild_id: guild for guild in config.guilds}
+        self.schedulers = {
+            guild.guild_id: SummaryScheduler(
+                load_scheduled_summaries(
+                    CronSchedule(guild.summary_cron)
+                    if guild.summary_cron
+                    else IntervalSchedule(guild.summary_interval),
+                    guild.summary_schedule_path,
+                ),
+                guild.summary_autostart,
+                guild.scheduler_state_path,
+            )
+            for guild in config.guilds
+        }
+        # Limits how many guilds' periodic summaries run at once. asyncio.Semaphore wakes waiters in
+        # the order they started waiting, so guilds take turns in the order their summaries became
+        # due, and a guild cannot run again while another guild is waiting.
+        self.guild_slots = asyncio.Semaphore(config.guild_concurrency)
+        self.message_store = (
+            MessageStore(config.message_store_path)
+            if config.message_store_path
+            else None
+        )
+        self.batch_summaries = BatchSummaryStore(
+            fingerprint(summarizer.config, config.preprocess_steps),
+            config.batch_summary_path or ":memory:",
+        )
+        self.token_counter = TokenCounter(summarizer.encoding, config.token_cache_size)
+        self.channel_index = ChannelIndex()
+        self.tldr_queue = JobQueue(config.tldr_workers, config.tldr_queue_size)
+        self.sender = PacedSender(config.output_send_interval)
+        # If set, periodic summaries are left to worker processes, and this process only fetches
+        # messages and posts summaries.
+        self.worker_queue = (
+            WorkerQueue(config.job_queue_path)
+            if config.worker_mode is WorkerMode.queue
+            else None
+        )
+        if self.worker_queue is not None:
+            # Results of jobs queued before a restart have no one to post them.
+            self.worker_queue.clear()
+        metrics.REGISTRY.collectors.append(self.collect_metrics)
+        # Channels whose stored messages have been brought up to date during this gateway session.
+        self.synced_channel_ids: set[int] = set()
 
     async def setup_hook(self) -> None:
-        guild = await self.fetch_guild(self.config.guild_id)
-        await guild.fetch_channels()
-        if not guild:
-            raise Exception(f"Failed to get guild with id {self.config.guild_id}")
-        self.tree.copy_global_to(guild=guild)
-        await self.tree.sync(guild=guild)
+        STARTUP.mark("login")
+        # Commands are synced by guild id, so guilds need not be fetched.
+        for guild_id in self.guild_configs:
+            guild = Object(id=guild_id)
+            self.tree.copy_global_to(guild=guild)
+            await self.sync_commands(guild)
+        STARTUP.mark("sync_commands")
+        self.tldr_queue.start()
+        if self.config.metrics_port is not None:
+            self.metrics_server = await metrics.serve(self.config.metrics_port)
         self.bg_task = self.loop.create_task(self.period_summary())
+        if self.message_store is not None:
+            self.prune_task = self.loop.create_task(
+                self.prune_message_store(self.message_store)
+            )
+            self.flush_task = self.loop.create_task(
+                self.flush_message_store(self.message_store)
+            )
+
+    async def sync_commands(self, guild: Object) -> None:
+        """
+        Syncs the command tree to the guild, unless it is unchanged since it was last synced and
+        command_hash_path is set. Syncing is rate limited by Discord, so syncing on every restart
+        can slow restarts down.
+        """
+        commands = [
+            command.to_dict() for command in self.tree.get_commands(guild=guild)
+        ]
+        tree_hash = hashlib.sha256(
+            json.dumps([self.application_id, commands], sort_keys=True).encode()
+        ).hexdigest()
+        path = self.config.command_hash_path
+        # Guild id -> hash of the commands last synced to it.
+        hashes: dict[str, str] = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                try:
+                    hashes = json.load(f)
+                except json.JSONDecodeError:
+                    # Written by an older version, which saved a single hash. Sync to replace it.
+                    pass
+            if hashes.get(str(guild.id)) == tree_hash:
+                print(f"Commands unchanged, skipping sync guild={guild.id}")
+                return
+        await self.tree.sync(guild=guild)
+        if path is not None:
+            hashes[str(guild.id)] = tree_hash
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(hashes, f)
+            os.replace(tmp_path, path)
+
+    def collect_metrics(self) -> None:
+        stats = self.tldr_queue.stats()
+        metrics.JOBS_QUEUED.set(stats.depth)
+        metrics.JOBS_RUNNING.set(stats.running)
 
     async def on_ready(self):
         assert self.user is not None, f"Not logged in!"
         print(f"Logged in as {self.user} (ID: {self.user.id})")
+        if not STARTUP.reported:
+            STARTUP.mark("connect")
+            STARTUP.report()
+        self.channel_index.reset()
+        if self.message_store is not None:
+            await self.backfill_message_store(self.message_store)
+
+    async def on_disconnect(self):
+        # Channels synced during this session hold every message received so far, so the next
+        # backfill need only fetch messages after them.
+        if self.message_store is not None:
+            self.message_store.advance_synced_to(self.synced_channel_ids)
+
+    async def on_message(self, message: Message):
+        if (
+            message.guild is None
+            or message.guild.id not in self.guild_configs
+            or not isinstance(message.channel, TextChannel)
+        ):
+            return
+        self.channel_index.add_message(message.channel.id, message.id)
+        if self.message_store is not None:
+            self.message_store.add([to_channel_message(message, message.channel)])
+
+    # Any of these may change which channels the bot can read.
+    async def on_guild_channel_create(self, channel: GuildChannel):
+        self.channel_index.invalidate_permissions()
+
+    async def on_guild_channel_update(self, before: GuildChannel, after: GuildChannel):
+        self.channel_index.invalidate_permissions()
+
+    async def on_guild_role_update(self, before: Role, after: Role):
+        self.channel_index.invalidate_permissions()
+
+    async def on_guild_role_delete(self, role: Role):
+        self.channel_index.invalidate_permissions()
+
+    async def on_member_update(self, before: Member, after: Member):
+        if after.id == self.application_id:
+            self.channel_index.invalidate_permissions()
+
+    async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
+        if "content" not in payload.data:
+            return
+        self.batch_summaries.invalidate(payload.channel_id, payload.message_id)
+        if self.message_store is not None:
+            edited_at = payload.data.get("edited_timestamp")
+            self.message_store.edit(
+                payload.message_id,
+                payload.data["content"],
+                datetime.fromisoformat(edited_at) if edited_at else utils.utcnow(),
+            )
+
+    async def on_raw_message_delete(self, payload: RawMessageDeleteEvent):
+        self.batch_summaries.invalidate(payload.channel_id, payload.message_id)
+        if self.message_store is not None:
+            self.message_store.delete([payload.message_id])
+
+    async def on_raw_bulk_message_delete(self, payload: RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            self.batch_summaries.invalidate(payload.channel_id, message_id)
+        if self.message_store is not None:
+            self.message_store.delete(payload.message_ids)
+
+    async def backfill_message_store(self, store: MessageStore):
+        """
+        Fetches messages sent while the bot was offline, i.e. since each channel was last known to
+        be complete, and drops messages older than self.config.message_store_retention.
+        """
+        # The gateway session may have been interrupted, so every channel must be synced again.
+        self.synced_channel_ids.clear()
+        retained_from = self.message_store_retained_from()
+        await asyncio.to_thread(store.prune, retained_from)
+        for guild_id in self.guild_configs:
+            guild = self.get_guild(guild_id)
+            if not guild:
+                raise Exception(f"Failed to get guild with id {guild_id}")
+            await self.backfill_guild(store, guild, retained_from)
+
+    def message_store_retained_from(self) -> int:
+        return utils.time_snowflake(
+            datetime.now() - timedelta(seconds=self.config.message_store_retention)
+        )
+
+    async def prune_message_store(self, store: MessageStore):
+        """
+        Drops messages older than self.config.message_store_retention every
+        MESSAGE_STORE_PRUNE_INTERVAL seconds, as backfilling only prunes on reconnecting.
+        """
+        while True:
+            await asyncio.sleep(MESSAGE_STORE_PRUNE_INTERVAL)
+            await asyncio.to_thread(store.prune, self.message_store_retained_from())
+
+    async def flush_message_store(self, store: MessageStore):
+        """
+        Writes the changes buffered from gateway events every MESSAGE_STORE_FLUSH_INTERVAL seconds,
+        off the event loop.
+        """
+        while True:
+            await asyncio.sleep(MESSAGE_STORE_FLUSH_INTERVAL)
+            await asyncio.to_thread(store.flush)
+
+    async def backfill_guild(
+        self, store: MessageStore, guild: Guild, retained_from: int
+    ):
+        bot_member = guild.me
+        if not bot_member:
+            raise Exception("Unable to find bot Discord user.")
+        for channel in guild.text_channels:
+            if not self.channel_index.can_read(channel, bot_member):
+                continue
+            # Start from where the channel was last known to be complete rather than from its last
+            # stored message, as messages sent since reconnecting are stored as they arrive, and
+            # would otherwise hide the messages sent while the bot was offline.
+            synced_from = store.synced_from(channel.id)
+            synced_to = store.synced_to(channel.id)
+            if synced_from is None or synced_to is None or synced_to < retained_from:
+                synced_from = synced_to = retained_from
+            print(f"Backfilling message store channel={channel.name}")
+            page: List[ChannelMessage] = []
+            async for msg in channel_messages(
+                channel, after=Object(id=synced_to), limit=None
+            ):
+                page.append(msg)
+                if len(page) >= DISCORD_PAGE_SIZE:
+                    store.add(page)
+                    await asyncio.to_thread(store.flush)
+                    page = []
+                synced_to = msg.id
+            store.add(page)
+            await asyncio.to_thread(store.flush)
+            store.mark_synced(channel.id, synced_from, synced_to)
+            self.synced_channel_ids.add(channel.id)
+
+    def max_messages_since(self, channel: TextChannel, since_id: int) -> Optional[int]:
+        """
+        Returns an upper bound on the number of messages sent in channel after the snowflake
+        since_id, or None if it is not known without fetching the channel's history.
+        """
+        if (
+            self.message_store is not None
+            and channel.id in self.synced_channel_ids
+            and self.message_store.covers(channel.id, since_id)
+        ):
+            return self.message_store.count(channel.id, since_id)
+        return self.channel_index.max_messages_since(channel, since_id)
+
+    def message_history(
+        self, channel: TextChannel, after_id: int, before: Optional[datetime] = None
+    ) -> AsyncIterator[ChannelMessage]:
+        """
+        Yields the channel's messages sent after the message (or snowflake) after_id and, if given,
+        before before. Messages are read from the local message store when it holds all of them,
+        otherwise they are fetched from Discord.
+        """
+        if (
+            self.message_store is not None
+            and channel.id in self.synced_channel_ids
+            and self.message_store.covers(channel.id, after_id)
+        ):
+            return self.message_store.messages(
+                channel.id,
+                after_id,
+                utils.time_snowflake(before) if before is not None else None,
+            )
+        return channel_messages(
+            channel, after=Object(id=after_id), before=before, limit=None
+        )
 
     async def period_summary(self):
         """
-        Each self.config.summary_interval, summarize server conversation.
+        Runs scheduled summaries of each guild's conversation while they are active.
         """
+        # Periodic summaries are not time sensitive, so let /tldr requests go first.
+        request_priority.set(Priority.background)
         await self.wait_until_ready()
-        self.last_summary_time = await self.deduce_last_summary_time()
-        while not self.is_closed():
-            while self.summary_active:
-                time_now = time.time()
-                if (
-                    time_since_last_summary := time_now - self.last_summary_time
-                ) > self.config.summary_interval:
-                    await self.summarise()
-                    self.last_summary_time = time_now
-                    await asyncio.sleep(self.config.summary_interval)
-                else:
-                    await asyncio.sleep(time_since_last_summary)
-            # if self.summary_active is set to False: only check for value changes once per second
-            # to avoid unnecessary CPU usage
-            await asyncio.sleep(1)
-
-    async def deduce_last_summary_time(self) -> float:
-        """
-        Returns time.time() - min(self.config.summary_interval, last_summary_time)
+        await asyncio.gather(
+            *(self.run_guild_schedule(guild) for guild in self.guild_configs.values())
+        )
+
+    async def run_guild_schedule(self, guild: GuildConfig) -> None:
+        scheduler = self.schedulers[guild.guild_id]
+        # Without saved scheduler state, look for the last summary in the output channel.
+        if not scheduler.has_state and scheduler.active:
+            scheduler.set_last_run("server", await self.deduce_last_summary_time(guild))
+        await scheduler.run(partial(self.run_scheduled_summary, guild))
+
+    async def run_scheduled_summary(
+        self, guild: GuildConfig, scheduled: ScheduledSummary, since: datetime
+    ) -> bool:
+        """
+        Returns whether the summary succeeded, so that the scheduler retries it if not.
+        """
+        try:
+            async with self.guild_slots:
+                with metrics.summary_run("periodic"):
+                    await self.summarise(
+                        guild,
+                        since,
+                        scheduled.channel_ids,
+                        scheduled.exclude_channel_ids,
+                    )
+        except Exception as e:
+            # Keep the schedule running if one summary fails.
+            print(
+                f"Scheduled summary {scheduled.key} failed guild={guild.guild_id}: {e!r}"
+            )
+            return False
+        return True
+
+    def output_channel(self, config: GuildConfig) -> tuple[Guild, TextChannel]:
+        """
+        Returns the guild and its summary output channel.
         """
         if not self.application_id:
             raise Exception("Not logged in!")
-        guild = self.get_guild(self.config.guild_id)
+        guild = self.get_guild(config.guild_id)
         if not guild:
-            raise Exception(f"Failed to get guild with id {self.config.guild_id}")
-        output_channel = utils.get(
-            guild.channels, id=self.config.summary_output_channel_id
-        )
+            raise Exception(f"Failed to get guild with id {config.guild_id}")
+        output_channel = utils.get(guild.channels, id=config.summary_output_channel_id)
         if output_channel is None:
-            raise Exception(f"Error: could not find channel with name {output_channel}")
-
+            raise Exception(
+                f"Error: could not find channel with id {config.summary_output_channel_id}"
+            )
         if not isinstance(output_channel, TextChannel):
             raise Exception("Output channel must be a text channel.")
+        return guild, output_channel
+
+    async def deduce_last_summary_time(self, config: GuildConfig) -> float:
+        """
+        Returns time.time() - min(config.summary_interval, last_summary_time)
+        """
+        _, output_channel = self.output_channel(config)
         earliest_possible_summary_time = datetime.now() - timedelta(
-            seconds=self.config.summary_interval
+            seconds=config.summary_interval
         )
         async for msg in output_channel.history(
             after=earliest_possible_summary_time, limit=None
         ):
-            if msg.author.id == self.application_id and msg.content.startswith(
+            # With OUTPUT_EMBEDS, the header starts the first embed rather than the content.
+            text = (msg.embeds[0].description or "") if msg.embeds else msg.content
+            if msg.author.id == self.application_id and text.startswith(
                 "Summarizing server activity since"
             ):
                 return msg.created_at.timestamp()
         return earliest_possible_summary_time.timestamp()
 
-    async def summarise_messages(
-        self, messages: List[ChannelMessage], output_channel: TextChannel
-    ):
-        msgs_in_batch: List[str] = []
-        # Initialize with token allocation for the prompts and a prefix, and OPENAI_TOKEN_BUFFER.
-        num_tokens_in_batch = 0
-        while len(messages) > 0:
-            msg = messages[0]
-            formatted_msg = f"{msg.timestamp.isoformat(timespec='seconds')}:{msg.channel.name}:{msg.author}:{msg.content}\n"
-            msg_tokens = len(self.summarizer.encoding.encode(formatted_msg))
-            # Edge case: need to handle this somehow
-            if msg_tokens > self.summarizer.max_msg_tokens:
-                raise Exception(
-                    f"Message too long to process: channel={msg.channel.name} num_tokens={msg_tokens}"
-                )
-            if msg_tokens + num_tokens_in_batch > self.summarizer.max_msg_tokens:
-                summary = await self.summarizer.summarize(
-                    msgs_in_batch,
-                )
-                await output_channel.send(format_summary_for_discord(summary))
-                msgs_in_batch = []
-                num_tokens_in_batch = 0
-            else:
-                num_tokens_in_batch += msg_tokens
-                msgs_in_batch.append(formatted_msg)
-                messages.pop(0)
-        # Process final batch
-        if msgs_in_batch:
-            summary = await self.summarizer.summarize(
-                msgs_in_batch,
+    def remember_batch_summary(self, channel_id: int, batch: Batch, summary: str):
+        """
+        Stores the summary of a full batch so that later summaries starting at the same message can
+        reuse it.
+        """
+        if batch.next_id is None:
+            return
+        self.batch_summaries.add(
+            channel_id,
+            BatchSummary(batch.first_id, batch.last_id, batch.next_id, summary),
+        )
+        self.batch_summaries.prune(
+            utils.time_snowflake(
+                datetime.now() - timedelta(seconds=self.config.batch_summary_retention)
             )
-            await output_channel.send(format_summary_for_discord(summary))
+        )
 
-    async def summarise(self):
-        if not self.application_id:
-            raise Exception("Not logged in!")
-        guild = self.get_guild(self.config.guild_id)
-        if not guild:
-            raise Exception(f"Failed to get guild with id {self.config.guild_id}")
-        output_channel = utils.get(
-            guild.channels, id=self.config.summary_output_channel_id
+    def composer(self, channel: TextChannel) -> OutputComposer:
+        return OutputComposer(channel, self.sender, self.config.output_embeds)
+
+    async def summarise_messages(
+        self,
+        messages: AsyncIterable[ChannelMessage],
+        channel_id: int,
+        output_channel: TextChannel,
+        previous_summaries: Sequence[str] = (),
+        progress: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        """
+        Summarizes messages from the channel with id channel_id, continuing on from
+        previous_summaries of earlier messages in the channel. progress, if given, is called with
+        the number of batches summarized so far as each batch is summarized.
+        """
+        pipeline = SummaryPipeline(
+            self.summarizer,
+            concurrency=self.config.summary_concurrency,
+            token_counter=self.token_counter,
+            preprocess_steps=self.config.preprocess_steps,
         )
-        if output_channel is None:
-            raise Exception(f"Error: could not find channel with name {output_channel}")
+        num_batches = 0
+        output = self.composer(output_channel)
+        if self.config.summary_mode is SummaryMode.batches:
+            for summary in previous_summaries:
+                await output.add(summary)
+            if self.config.stream_summaries:
+                await output.flush()
+                async for batch in pipeline.batches(messages):
+                    live_message = LiveMessage(output_channel)
+                    pieces: List[str] = []
+                    async for piece in self.summarizer.summarize_stream(
+                        batch.messages, num_tokens=batch.num_tokens
+                    ):
+                        pieces.append(piece)
+                        await live_message.write(piece)
+                    await live_message.close()
+                    self.remember_batch_summary(channel_id, batch, "".join(pieces))
+                    if progress is not None:
+                        num_batches += 1
+                        await progress(num_batches)
+                return
+            async for batch, summary in pipeline.summarized_batches(messages):
+                self.remember_batch_summary(channel_id, batch, summary)
+                await output.add(summary)
+                if progress is not None:
+                    num_batches += 1
+                    await progress(num_batches)
+            await output.flush()
+            return
+        summaries = list(previous_summaries)
+        async for batch, summary in pipeline.summarized_batches(messages):
+            self.remember_batch_summary(channel_id, batch, summary)
+            summaries.append(summary)
+            if progress is not None:
+                num_batches += 1
+                await progress(num_batches)
+        if summaries:
+            summary = await self.summarizer.combine(summaries)
+            await output.add(summary)
+            await output.flush()
 
-        if not isinstance(output_channel, TextChannel):
-            raise Exception("Output channel must be a text channel.")
-        since = datetime.now() - timedelta(seconds=self.config.summary_interval)
-        await output_channel.send(
-            f"""
-            Summarizing server activity since <t:{str(since.timestamp()).split('.')[0]}>. Any channels with fewer than {self.config.summary_msg_lower_limit} messages in this period will be ignored.
-            """
+    async def summarise(
+        self,
+        config: GuildConfig,
+        since: datetime,
+        channel_ids: Optional[Collection[int]] = None,
+        exclude_channel_ids: Collection[int] = (),
+    ):
+        """
+        Summarizes messages sent in the guild since since in the channels with ids channel_ids, or
+        in all channels except those in exclude_channel_ids if channel_ids is None.
+        """
+        guild, output_channel = self.output_channel(config)
+        # Headers and summaries are packed into as few messages as fit them, rather than posting a
+        # message for each.
+        output = self.composer(output_channel)
+        await output.add(
+            f"Summarizing server activity since <t:{str(since.timestamp()).split('.')[0]}>. Any channels with fewer than {config.summary_msg_lower_limit} messages in this period will be ignored."
         )
-        channels = guild.text_channels
-        for channel in channels:
-            bot_member = utils.get(guild.members, id=self.application_id)
-            if not bot_member:
-                raise Exception("Unable to find bot Discord user.")
-            permissions = channel.permissions_for(bot_member)
-            if not permissions.read_messages:
-                continue
+        bot_member = guild.me
+        if not bot_member:
+            raise Exception("Unable to find bot Discord user.")
+        since_id = utils.time_snowflake(since)
+        channels = []
+        for channel in guild.text_channels:
             # This stops the bot summarizing previous summaries.
-            if channel.id == self.config.summary_output_channel_id:
+            if channel.id == config.summary_output_channel_id:
                 continue
-            print(f"Processing messages channel={channel.name}")
-            messages = [
-                ChannelMessage(
-                    msg.author.name,
-                    msg.content,
-                    ChannelInfo(channel.name, channel.id),
-                    msg.created_at,
+            if channel_ids is not None and channel.id not in channel_ids:
+                continue
+            if channel.id in exclude_channel_ids:
+                continue
+            if not self.channel_index.can_read(channel, bot_member):
+                continue
+            # Skip channels known to have too few messages without fetching their history.
+            max_messages = self.max_messages_since(channel, since_id)
+            if max_messages is not None and (
+                max_messages == 0 or max_messages < config.summary_msg_lower_limit
+            ):
+                continue
+            channels.append(channel)
+        self.channel_index.prune(since_id, (channel.id for channel in channels))
+        server_summaries: List[str] = []
+        async for channel, summaries in self.channel_summaries(
+            channels, since, config.summary_msg_lower_limit
+        ):
+            if summaries is None:
+                continue
+            if self.config.summary_mode is SummaryMode.server:
+                server_summaries.extend(
+                    f"#{channel.name}:\n{summary}" for summary in summaries
                 )
-                async for msg in channel.history(after=since, limit=None)
-            ]
-            if len(messages) < self.config.summary_msg_lower_limit:
                 continue
-            await output_channel.send(f"Summary of <#{channel.id}>:\n\n")
-            msgs_in_batch = []
-            # Initialize with token allocation for the prompts and a prefix, and OPENAI_TOKEN_BUFFER.
-            num_tokens_in_batch = 0
-            while len(messages) > 0:
-                msg = messages[0]
-                formatted_msg = f"{msg.timestamp.isoformat(timespec='seconds')}:{msg.channel.name}:{msg.author}:{msg.content}\n"
-                msg_tokens = len(self.summarizer.encoding.encode(formatted_msg))
-                # Edge case: need to handle this somehow
-                if msg_tokens > self.summarizer.max_msg_tokens:
-                    raise Exception(
-                        f"Message too long to process: channel={channel.name} num_tokens={msg_tokens}"
-                    )
-                if msg_tokens + num_tokens_in_batch > self.summarizer.max_msg_tokens:
-                    summary = await self.summarizer.summarize(
-                        msgs_in_batch,
+            await output.add(f"Summary of <#{channel.id}>:")
+            for summary in summaries:
+                await output.add(summary)
+        if server_summaries:
+            summary = await self.combine(server_summaries)
+            await output.add(summary)
+        await output.flush()
+
+    async def channel_summaries(
+        self, channels: List[TextChannel], since: datetime, min_messages: int
+    ) -> AsyncIterator[tuple[TextChannel, Optional[List[str]]]]:
+        """
+        Yields each of channels in order with the summaries of its messages sent after since, as
+        summarise_channel.
+        """
+        if self.periodic_summarizer is not None and self.worker_queue is None:
+            for channel, summaries in zip(
+                channels,
+                await self.summarise_channels_together(channels, since, min_messages),
+            ):
+                yield channel, summaries
+            return
+        # Channels are fetched and summarized concurrently, but results are posted in the order of
+        # guild.text_channels so that output is deterministic.
+        semaphore = asyncio.Semaphore(self.config.summary_concurrency)
+        tasks = [
+            asyncio.create_task(
+                self.summarise_channel(channel, since, semaphore, min_messages)
+            )
+            for channel in channels
+        ]
+        try:
+            for channel, task in zip(channels, tasks):
+                yield channel, await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def summarise_channels_together(
+        self, channels: List[TextChannel], since: datetime, min_messages: int
+    ) -> List[Optional[List[str]]]:
+        """
+        As summarise_channel for each of channels, but sends the batches of all channels to
+        self.periodic_summarizer in a single summarize_many call.
+        """
+        assert self.periodic_summarizer is not None
+        summarizer = self.periodic_summarizer
+        semaphore = asyncio.Semaphore(self.config.summary_concurrency)
+
+        async def channel_batches(channel: TextChannel) -> Optional[List[Batch]]:
+            async with semaphore:
+                pipeline = SummaryPipeline(
+                    summarizer,
+                    min_messages=min_messages,
+                    token_counter=self.token_counter,
+                    preprocess_steps=self.config.preprocess_steps,
+                )
+                batches = [
+                    batch
+                    async for batch in pipeline.batches(
+                        self.message_history(channel, utils.time_snowflake(since))
                     )
-                    await output_channel.send(format_summary_for_discord(summary))
-                    msgs_in_batch = []
-                    num_tokens_in_batch = 0
-                else:
-                    num_tokens_in_batch += msg_tokens
-                    msgs_in_batch.append(formatted_msg)
-                    messages.pop(0)
-            # Process final batch
-            if msgs_in_batch:
-                summary = await self.summarizer.summarize(
-                    msgs_in_batch,
+                ]
+                return None if pipeline.skipped else batches
+
+        all_batches = await asyncio.gather(
+            *(channel_batches(channel) for channel in channels)
+        )
+        batches = [batch for batches in all_batches if batches for batch in batches]
+        summaries = iter(
+            await summarizer.summarize_many(
+                [batch.messages for batch in batches],
+                num_tokens=[batch.num_tokens for batch in batches],
+            )
+        )
+        results: List[Optional[List[str]]] = []
+        for channel, channel_batches_ in zip(channels, all_batches):
+            if channel_batches_ is None:
+                results.append(None)
+                continue
+            channel_summaries = []
+            for batch, summary in zip(channel_batches_, summaries):
+                self.remember_batch_summary(channel.id, batch, summary)
+                channel_summaries.append(summary)
+            if (
+                self.config.summary_mode is SummaryMode.channel
+                and len(channel_summaries) > 1
+            ):
+                channel_summaries = [await summarizer.combine(channel_summaries)]
+            results.append(channel_summaries)
+        return results
+
+    async def summarise_channel(
+        self,
+        channel: TextChannel,
+        since: datetime,
+        semaphore: asyncio.Semaphore,
+        min_messages: int,
+    ) -> Optional[List[str]]:
+        """
+        Summarize messages sent in channel after since. Returns None if the channel had fewer than
+        min_messages messages in that period.
+        """
+        if self.worker_queue is not None:
+            return await self.summarise_channel_in_worker(
+                channel, since, semaphore, min_messages
+            )
+        async with semaphore:
+            print(f"Processing messages channel={channel.name}")
+            pipeline = SummaryPipeline(
+                self.summarizer,
+                min_messages=min_messages,
+                concurrency=self.config.summary_concurrency,
+                token_counter=self.token_counter,
+                preprocess_steps=self.config.preprocess_steps,
+            )
+            summaries: List[str] = []
+            async for batch, summary in pipeline.summarized_batches(
+                self.message_history(channel, utils.time_snowflake(since))
+            ):
+                self.remember_batch_summary(channel.id, batch, summary)
+                summaries.append(summary)
+            if pipeline.skipped:
+                return None
+            if self.config.preprocess_steps:
+                print(
+                    f"Preprocessing saved {pipeline.original_tokens - pipeline.num_tokens} of {pipeline.original_tokens} tokens channel={channel.name}"
                 )
-                await output_channel.send(format_summary_for_discord(summary))
+            if self.config.summary_mode is SummaryMode.channel and len(summaries) > 1:
+                return [await self.summarizer.combine(summaries)]
+            return summaries
+
+    async def summarise_channel_in_worker(
+        self,
+        channel: TextChannel,
+        since: datetime,
+        semaphore: asyncio.Semaphore,
+        min_messages: int,
+    ) -> Optional[List[str]]:
+        """
+        As summarise_channel, but only fetches the messages, and queues them to be summarized by a
+        worker process.
+        """
+        queue = self.worker_queue
+        assert queue is not None
+        async with semaphore:
+            print(f"Processing messages channel={channel.name}")
+            # Messages are added to the job a page at a time, and encoded and written off the event
+            # loop, so that a busy channel is never held in memory or encoded all at once.
+            job_id = await asyncio.to_thread(
+                queue.enqueue,
+                CHANNEL_JOB,
+                channel_job(
+                    self.config.preprocess_steps,
+                    self.config.summary_concurrency,
+                    self.config.summary_mode is SummaryMode.channel,
+                ),
+                pending=True,
+            )
+            num_messages = 0
+            try:
+                page: List[ChannelMessage] = []
+                async for msg in metrics.timed_iter(
+                    "fetch", self.message_history(channel, utils.time_snowflake(since))
+                ):
+                    page.append(msg)
+                    if len(page) >= DISCORD_PAGE_SIZE:
+                        await asyncio.to_thread(queue.add_page, job_id, page)
+                        num_messages += len(page)
+                        page = []
+                if page:
+                    await asyncio.to_thread(queue.add_page, job_id, page)
+                    num_messages += len(page)
+            except BaseException:
+                await asyncio.to_thread(queue.delete, job_id)
+                raise
+            metrics.record_messages(num_messages)
+            if num_messages < min_messages:
+                await asyncio.to_thread(queue.delete, job_id)
+                return None
+            if not num_messages:
+                await asyncio.to_thread(queue.delete, job_id)
+                return []
+            await asyncio.to_thread(queue.submit, job_id)
+        # The semaphore only limits fetching, so that as many channels are summarized at once as
+        # workers have capacity for.
+        with metrics.timed("worker"):
+            result = await queue.result(job_id)
+        for batch in result["batches"]:
+            self.remember_batch_summary(
+                channel.id,
+                Batch(
+                    first_id=batch["first_id"],
+                    last_id=batch["last_id"],
+                    next_id=batch["next_id"],
+                ),
+                batch["summary"],
+            )
+        return result["summaries"]
+
+    async def combine(self, summaries: List[str]) -> str:
+        """
+        Combines summaries into one, in a worker process if there are any.
+        """
+        if self.worker_queue is None:
+            return await self.summarizer.combine(summaries)
+        job_id = await asyncio.to_thread(
+            self.worker_queue.enqueue, COMBINE_JOB, {"summaries": summaries}
+        )
+        with metrics.timed("worker"):
+            return (await self.worker_queue.result(job_id))["summary"]
+
+
+def is_authorized(guild: GuildConfig, user_id: int) -> bool:
+    return not guild.authorized_user_ids or user_id in guild.authorized_user_ids
 
 
 def register_commands(client: DiscordClient) -> None:
     @client.tree.command(name="activate_summary")
     async def activate_summary(interaction: Interaction):
-        if (
-            len((authd_users := client.config.authorized_user_ids)) > 0
-            and str(interaction.user.id) not in authd_users
-        ):
+        guild = client.guild_configs.get(interaction.guild_id or 0)
+        if guild is None or not is_authorized(guild, interaction.user.id):
             await interaction.response.send_message(
                 "You do not have permission to use this command."
             )
             return
-        client.summary_active = True
-        last_summary_time = await client.deduce_last_summary_time()
-        time_now = time.time()
-        time_left = min(
-            int(time_now - last_summary_time - client.config.summary_interval), 0
+        scheduler = client.schedulers[guild.guild_id]
+        scheduler.set_active(True)
+        _, next_run = scheduler.next_run()
+        schedule = (
+            f"on the schedule `{guild.summary_cron}`"
+            if guild.summary_cron
+            else f"every {guild.summary_interval} seconds"
         )
         await interaction.response.send_message(
-            f"Summaries activated. Sending server summaries to <#{client.config.summary_output_channel_id}> every {client.config.summary_interval} seconds. Next summary in {time_left} seconds."
+            f"Summaries activated. Sending server summaries to <#{guild.summary_output_channel_id}> {schedule}. Next summary <t:{int(next_run.timestamp())}:R>."
         )
 
     @client.tree.command(name="deactivate_summary")
     async def deactivate_summary(interaction: Interaction):
-        if (
-            len((authd_users := client.config.authorized_user_ids)) > 0
-            and str(interaction.user.id) not in authd_users
-        ):
+        guild = client.guild_configs.get(interaction.guild_id or 0)
+        if guild is None or not is_authorized(guild, interaction.user.id):
             await interaction.response.send_message(
                 "You do not have permission to use this command."
             )
             return
-        client.summary_active = False
+        client.schedulers[guild.guild_id].set_active(False)
         await interaction.response.send_message("Summaries deactivated.")
 
+    @client.tree.command(name="tldr_stats")
+    async def tldr_stats(interaction: Interaction):
+        guild = client.guild_configs.get(interaction.guild_id or 0)
+        # Unlike other commands, stats are not open to everyone when no users are authorized.
+        if guild is None or interaction.user.id not in guild.authorized_user_ids:
+            await interaction.response.send_message(
+                "You do not have permission to use this command."
+            )
+            return
+        lines = ["**Recent summaries**"]
+        for run in list(metrics.recent_runs)[-5:]:
+            slowest = max(run.stage_seconds.items(), key=lambda item: item[1])
+            lines.append(
+                f"<t:{int(run.started_at)}:R> {run.kind}: {run.duration:.1f}s, {run.messages} messages, {run.llm_requests} AI requests, {run.input_tokens}+{run.output_tokens} tokens, slowest stage {slowest[0]} ({slowest[1]:.1f}s)"
+                if run.stage_seconds
+                else f"<t:{int(run.started_at)}:R> {run.kind}: {run.duration:.1f}s"
+            )
+        lines.append("**Stages** (total time, summed over concurrent work)")
+        for (stage,), values in metrics.STAGE_SECONDS.values.items():
+            lines.append(
+                f"{stage}: {values.count} times, {values.sum:.1f}s total, {values.sum / values.count:.2f}s mean"
+            )
+        stats = client.tldr_queue.stats()
+        lines.append(
+            f"**/tldr queue**: {stats.depth} queued, {stats.running} running, {stats.mean_wait:.1f}s mean wait, {stats.max_wait:.1f}s max wait"
+        )
+        cache = metrics.CACHE_LOOKUPS.values
+        lines.append(
+            f"**Summary cache**: {int(cache.get(('hit',), 0))} hits, {int(cache.get(('miss',), 0))} misses"
+        )
+        await interaction.response.send_message(
+            split_text("\n".join(lines))[0], ephemeral=True
+        )
+
     @app_commands.describe(
         message_link="Discord link to a message in this server. All messages in the channel that the message was sent in after and including the linked message will be summarized.",
     )
     @client.tree.command(name="tldr")
     async def tldr(interaction: Interaction, message_link: str):
-        if (
-            len((authd_users := client.config.authorized_user_ids)) > 0
-            and str(interaction.user.id) not in authd_users
-        ):
+        guild = client.guild_configs.get(interaction.guild_id or 0)
+        if guild is None or not is_authorized(guild, interaction.user.id):
             await interaction.response.send_message(
                 "You do not have permission to use this command."
             )
@@ -281,47 +901,82 @@ def register_commands(client: DiscordClient) -> None:
         message_id = int(message_id)
 
         # Do not allow summaries of messages from other guilds
-        if guild_id != client.config.guild_id:
+        if guild_id != guild.guild_id:
             await interaction.response.send_message(
                 "Linked message is not from this server."
             )
             return
 
+        if client.tldr_queue.full():
+            await interaction.response.send_message(
+                "Too many tl;dr requests are in progress. Please try again later."
+            )
+            return
+        # Checks below require Discord API calls, and summarizing can take a long time, so respond
+        # now and finish the request in the background.
+        await interaction.response.defer(thinking=True)
+        await interaction.edit_original_response(
+            content=f"Queued behind {client.tldr_queue.stats().depth} other tl;dr requests."
+        )
+        try:
+            client.tldr_queue.submit(
+                f"tldr {message_link}",
+                lambda: summarise_link(
+                    interaction, message_link, guild_id, channel_id, message_id
+                ),
+            )
+        except asyncio.QueueFull:
+            # Other requests may have filled the queue while responding.
+            await interaction.edit_original_response(
+                content="Too many tl;dr requests are in progress. Please try again later."
+            )
+
+    async def summarise_link(
+        interaction: Interaction,
+        message_link: str,
+        guild_id: int,
+        channel_id: int,
+        message_id: int,
+    ) -> None:
+        async def respond(content: str) -> None:
+            try:
+                await interaction.edit_original_response(content=content)
+            except HTTPException:
+                # Interaction responses can only be edited for 15 minutes, which may have passed
+                # while the request was queued.
+                pass
+
         guild = client.get_guild(guild_id)
         if not guild:
-            await interaction.response.send_message("An error occurred.")
-            print(f"Failed to get guild with id {client.config.guild_id}")
+            await respond("An error occurred.")
+            print(f"Failed to get guild with id {guild_id}")
             return
 
         # Check that the bot has permission to write to the channel from which the interaction was sent
         bot_member = utils.get(guild.members, id=client.application_id)
         if not bot_member:
-            await interaction.response.send_message("An error occurred.")
+            await respond("An error occurred.")
             print(f"Unable to find bot Discord user id = {client.application_id}.")
             return
         output_channel = interaction.channel
         if output_channel is None:
-            await interaction.response.send_message("An error occurred.")
+            await respond("An error occurred.")
             print(f"Unable to find output channel.")
             return
         bot_permissions_output = output_channel.permissions_for(bot_member)
         if not bot_permissions_output.send_messages:
-            await interaction.response.send_message(
-                "I don't have permission to read that channel."
-            )
+            await respond("I don't have permission to read that channel.")
             return
 
         # Check output channel is of type TextChannel
         if output_channel.type != ChannelType.text:
-            await interaction.response.send_message(
-                "tl;dr must be used in a text channel."
-            )
+            await respond("tl;dr must be used in a text channel.")
             return
 
         # Check that the channel exists
         channel = utils.get(guild.text_channels, id=channel_id)
         if channel is None:
-            await interaction.response.send_message("Could not find message channel.")
+            await respond("Could not find message channel.")
             print(f"Error: could not find channel with id {channel_id}")
             return
 
@@ -329,22 +984,18 @@ def register_commands(client: DiscordClient) -> None:
         # Without this, tl;drs of hidden channels may be exposed
         everyone_role = utils.get(guild.roles, name="@everyone")
         if everyone_role is None:
-            await interaction.response.send_message("An error occurred.")
-            print(
-                f"Unable to find @everyone Discord role guild_id = {client.config.guild_id}."
-            )
+            await respond("An error occurred.")
+            print(f"Unable to find @everyone Discord role guild_id = {guild_id}.")
             return
         everyone_permissions = channel.permissions_for(everyone_role)
         if not everyone_permissions.read_messages:
-            await interaction.response.send_message("Could not find message channel.")
+            await respond("Could not find message channel.")
             return
 
         # Check that the bot has permission to read the channel
         bot_permissions = channel.permissions_for(bot_member)
         if not bot_permissions.read_messages:
-            await interaction.response.send_message(
-                "I don't have permission to read that channel."
-            )
+            await respond("I don't have permission to read that channel.")
             return
 
         try:
@@ -352,32 +1003,46 @@ def register_commands(client: DiscordClient) -> None:
             starting_message = await channel.fetch_message(message_id)
         except NotFound:
             # If the message is not found in the channel
-            await interaction.response.send_message("Message not found.")
+            await respond("Message not found.")
             return
         except HTTPException:
             # If fetching the message failed due to other reasons
-            await interaction.response.send_message("Failed to fetch the message.")
+            await respond("Failed to fetch the message.")
             return
 
-        messages = [
-            ChannelMessage(
-                starting_message.author.name,
-                starting_message.content,
-                ChannelInfo(channel.name, channel.id),
-                starting_message.created_at,
-            )
-        ] + [
-            ChannelMessage(
-                msg.author.name,
-                msg.content,
-                ChannelInfo(channel.name, channel.id),
-                msg.created_at,
+        # Reuse summaries of batches starting at the linked message from earlier summaries, and only
+        # summarize messages sent after them.
+        reused = client.batch_summaries.chain(channel.id, starting_message.id)
+
+        async def messages() -> AsyncIterator[ChannelMessage]:
+            if reused:
+                after_id = reused[-1].next_id - 1
+            else:
+                yield to_channel_message(starting_message, channel)
+                after_id = starting_message.id
+            # Only include messages sent before the /tldr command was used.
+            async for msg in client.message_history(
+                channel, after_id, interaction.created_at
+            ):
+                yield msg
+
+        async def report_progress(num_batches: int) -> None:
+            await respond(
+                f"Summarizing messages since {message_link}. Summarized {num_batches} batches of messages so far."
             )
-            async for msg in channel.history(after=starting_message, limit=None)
-        ]
-        # Ignore last message, which is the /tldr command.
-        messages = messages[:-1] if len(messages) > 1 else messages
-        await interaction.response.send_message(
-            f"Summarizing {len(messages)} messages."
-        )
-        await client.summarise_messages(messages, output_channel)
+
+        await respond(f"Summarizing messages since {message_link}.")
+        try:
+            with metrics.summary_run("tldr"):
+                await client.summarise_messages(
+                    messages(),
+                    channel.id,
+                    output_channel,
+                    [batch_summary.summary for batch_summary in reused],
+                    report_progress,
+                )
+        except Exception as e:
+            print(f"tl;dr failed link={message_link}: {e!r}")
+            await respond("An error occurred.")
+            return
+        await respond(f"Summarized messages since {message_link}.")
@@ -0,0 +1,84 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, List
+
+from . import metrics
+
+# Number of recent jobs whose wait times are reported in JobQueueStats.
+RECENT_JOBS = 100
+
+
+@dataclass
+class Job:
+    name: str
+    run: Callable[[], Awaitable[None]]
+    enqueued_at: float
+
+
+@dataclass
+class JobQueueStats:
+    depth: int
+    running: int
+    # Over the last RECENT_JOBS jobs.
+    mean_wait: float
+    max_wait: float
+
+
+class JobQueue:
+    """
+    Runs jobs in the order they are submitted on a fixed number of worker tasks.
+    """
+
+    def __init__(self, num_workers: int, max_size: int = 0):
+        self.num_workers = num_workers
+        self.running = 0
+        self.queue: asyncio.Queue[Job] = asyncio.Queue(max_size)
+        self.wait_times: Deque[float] = deque(maxlen=RECENT_JOBS)
+        self.workers: List[asyncio.Task[None]] = []
+
+    def start(self) -> None:
+        self.workers = [
+            asyncio.create_task(self._work()) for _ in range(self.num_workers)
+        ]
+
+    def full(self) -> bool:
+        return self.queue.full()
+
+    def submit(self, name: str, run: Callable[[], Awaitable[None]]) -> int:
+        """
+        Enqueues a job, returning its position in the queue. Raises asyncio.QueueFull if the queue
+        is full.
+        """
+        self.queue.put_nowait(Job(name, run, time.monotonic()))
+        return self.queue.qsize()
+
+    def stats(self) -> JobQueueStats:
+        return JobQueueStats(
+            self.queue.qsize(),
+            self.running,
+            sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0,
+            max(self.wait_times, default=0),
+        )
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            wait = time.monotonic() - job.enqueued_at
+            self.wait_times.append(wait)
+            metrics.JOB_WAIT_SECONDS.observe(wait)
+            self.running += 1
+            started_at = time.monotonic()
+            try:
+                await job.run()
+            except Exception:
+                print(f"Job failed name={job.name}")
+                traceback.print_exc()
+            finally:
+                self.running -= 1
+                self.queue.task_done()
+            print(
+                f"Job done name={job.name} wait={wait:.1f}s run={time.monotonic() - started_at:.1f}s depth={self.queue.qsize()}"
+            )
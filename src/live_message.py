@@ -0,0 +1,59 @@
+import time
+from typing import Optional
+
+from discord import Message, TextChannel
+
+from . import metrics
+
+# Discord message size is at most 2000 characters.
+MAX_MESSAGE_LENGTH = 2000
+
+
+class LiveMessage:
+    """
+    Posts text to a channel as it is written, editing the posted message in place. Edits are
+    coalesced so that the message is updated at most once every min_edit_interval seconds. Text that
+    would take a message over Discord's length limit rolls over into a new message, split at a line
+    boundary where possible.
+    """
+
+    def __init__(self, channel: TextChannel, min_edit_interval: float = 1.0):
+        self.channel = channel
+        self.min_edit_interval = min_edit_interval
+        self._message: Optional[Message] = None
+        # Text of the current message, and how much of it has been posted.
+        self._text = ""
+        self._posted_text = ""
+        self._posted_at = 0.0
+
+    async def write(self, text: str) -> None:
+        self._text += text
+        while len(self._text) > MAX_MESSAGE_LENGTH:
+            split_at = self._text.rfind("\n", 0, MAX_MESSAGE_LENGTH) + 1
+            if split_at <= 0:
+                split_at = MAX_MESSAGE_LENGTH
+            self._text, rest = self._text[:split_at], self._text[split_at:]
+            await self._post()
+            self._message = None
+            self._text = rest
+            self._posted_text = ""
+        if time.monotonic() - self._posted_at >= self.min_edit_interval:
+            await self._post()
+
+    async def close(self) -> None:
+        """
+        Posts any text that has not been posted yet.
+        """
+        await self._post()
+
+    async def _post(self) -> None:
+        # Discord does not allow empty messages.
+        if self._text == self._posted_text or not self._text.strip():
+            return
+        with metrics.timed("send"):
+            if self._message is None:
+                self._message = await self.channel.send(self._text)
+            else:
+                await self._message.edit(content=self._text)
+        self._posted_text = self._text
+        self._posted_at = time.monotonic()
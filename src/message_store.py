@@ -0,0 +1,200 @@
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import AsyncIterator, Deque, Iterable, List, Optional, Tuple
+
+from .messages import ChannelInfo, ChannelMessage
+
+# Number of rows read per query when streaming messages out of the store.
+STORE_PAGE_SIZE = 100
+
+
+class MessageStore:
+    """
+    Local SQLite copy of guild messages, kept up to date from gateway events so that summaries can be
+    produced without paging through channel history over the Discord API.
+
+    For each channel, the store records the message id from which its copy is complete, and the
+    message id up to which it was last known to be complete. Messages older than the first must
+    still be fetched from Discord, and messages newer than the second may be missing messages sent
+    while the bot was offline.
+
+    Changes from gateway events are buffered, and written by flush, which the bot calls off the
+    event loop. Other methods flush first, so that they see every change made so far.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Stops transactions from different threads interleaving on the one connection.
+        self.lock = threading.Lock()
+        # Statements and their parameters, in the order the changes were made. deque appends and
+        # pops are thread safe, so changes can be buffered while another thread flushes.
+        self._pending: Deque[Tuple[str, List[tuple]]] = deque()
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                channel_name TEXT NOT NULL,
+                author TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                edited_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS messages_by_channel ON messages (channel_id, id);
+            CREATE TABLE IF NOT EXISTS channels (
+                id INTEGER PRIMARY KEY,
+                synced_from INTEGER NOT NULL,
+                synced_to INTEGER
+            );
+            """
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(messages)")}
+        if "edited_at" not in columns:
+            self.db.execute("ALTER TABLE messages ADD COLUMN edited_at REAL")
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(channels)")}
+        if "synced_to" not in columns:
+            self.db.execute("ALTER TABLE channels ADD COLUMN synced_to INTEGER")
+
+    def add(self, messages: Iterable[ChannelMessage]) -> None:
+        self._pending.append(
+            (
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        msg.id,
+                        msg.channel.id,
+                        msg.channel.name,
+                        msg.author,
+                        msg.content,
+                        msg.timestamp.timestamp(),
+                        msg.edited_at.timestamp() if msg.edited_at else None,
+                    )
+                    for msg in messages
+                ],
+            )
+        )
+
+    def edit(self, message_id: int, content: str, edited_at: datetime) -> None:
+        self._pending.append(
+            (
+                "UPDATE messages SET content = ?, edited_at = ? WHERE id = ?",
+                [(content, edited_at.timestamp(), message_id)],
+            )
+        )
+
+    def delete(self, message_ids: Iterable[int]) -> None:
+        self._pending.append(
+            ("DELETE FROM messages WHERE id = ?", [(id,) for id in message_ids])
+        )
+
+    def flush(self) -> None:
+        """
+        Writes buffered changes in one transaction.
+        """
+        with self.lock, self.db:
+            while self._pending:
+                statement, rows = self._pending.popleft()
+                self.db.executemany(statement, rows)
+
+    def synced_from(self, channel_id: int) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT synced_from FROM channels WHERE id = ?", (channel_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def synced_to(self, channel_id: int) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT synced_to FROM channels WHERE id = ?", (channel_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def mark_synced(self, channel_id: int, synced_from: int, synced_to: int) -> None:
+        self.flush()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO channels VALUES (?, ?, ?)",
+                (channel_id, synced_from, synced_to),
+            )
+
+    def advance_synced_to(self, channel_ids: Iterable[int]) -> None:
+        """
+        Moves the channels' synced_to forward to their last stored message, for channels whose
+        messages are known to have all been stored up to now.
+        """
+        self.flush()
+        with self.lock, self.db:
+            self.db.executemany(
+                """
+                UPDATE channels SET synced_to = MAX(
+                    COALESCE(synced_to, 0),
+                    (SELECT COALESCE(MAX(id), 0) FROM messages WHERE channel_id = channels.id)
+                )
+                WHERE id = ?
+                """,
+                ((id,) for id in channel_ids),
+            )
+
+    def covers(self, channel_id: int, after_id: int) -> bool:
+        """
+        Whether every message in the channel after after_id is held in the store.
+        """
+        synced_from = self.synced_from(channel_id)
+        return synced_from is not None and synced_from <= after_id
+
+    def count(self, channel_id: int, after_id: int) -> int:
+        self.flush()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*) FROM messages WHERE channel_id = ? AND id > ?",
+                (channel_id, after_id),
+            ).fetchone()
+        return row[0]
+
+    def prune(self, before_id: int) -> None:
+        """
+        Deletes messages older than before_id and moves channels' synced_from forward to match.
+        """
+        self.flush()
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM messages WHERE id < ?", (before_id,))
+            self.db.execute(
+                "UPDATE channels SET synced_from = ? WHERE synced_from < ?",
+                (before_id, before_id),
+            )
+
+    async def messages(
+        self, channel_id: int, after_id: int, before_id: Optional[int] = None
+    ) -> AsyncIterator[ChannelMessage]:
+        """
+        Yields the channel's messages with after_id < id < before_id, oldest first.
+        """
+        self.flush()
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    """
+                    SELECT id, channel_name, author, content, created_at, edited_at
+                    FROM messages
+                    WHERE channel_id = ? AND id > ? AND id < ?
+                    ORDER BY id LIMIT ?
+                    """,
+                    (channel_id, after_id, before_id or 2**63 - 1, STORE_PAGE_SIZE),
+                ).fetchall()
+            for id, channel_name, author, content, created_at, edited_at in rows:
+                yield ChannelMessage(
+                    author,
+                    content,
+                    ChannelInfo(channel_name, channel_id),
+                    datetime.fromtimestamp(created_at, timezone.utc),
+                    id,
+                    datetime.fromtimestamp(edited_at, timezone.utc)
+                    if edited_at is not None
+                    else None,
+                )
+            if len(rows) < STORE_PAGE_SIZE:
+                return
+            after_id = rows[-1][0]
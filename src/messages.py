@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import List, Optional, Union
+
+
+@dataclass(frozen=True)
+class ChannelInfo:
+    name: str
+    id: int
+
+
+@dataclass
+class ChannelMessage:
+    author: str
+    content: str
+    channel: ChannelInfo
+    timestamp: datetime
+    id: int
+    edited_at: Optional[datetime] = None
+
+
+def _parse_time(value: Union[str, float, int]) -> datetime:
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(value, timezone.utc)
+
+
+def message_to_dict(msg: ChannelMessage) -> dict:
+    """
+    Returns msg as a JSON-serializable dict with the same fields as the message store.
+    """
+    return {
+        "id": msg.id,
+        "channel_id": msg.channel.id,
+        "channel_name": msg.channel.name,
+        "author": msg.author,
+        "content": msg.content,
+        "created_at": msg.timestamp.timestamp(),
+        "edited_at": msg.edited_at.timestamp() if msg.edited_at else None,
+    }
+
+
+def message_from_dict(row: dict) -> ChannelMessage:
+    """
+    Inverse of message_to_dict. Times may also be ISO 8601 strings, and created_at may be missing.
+    """
+    return ChannelMessage(
+        row["author"],
+        row["content"],
+        ChannelInfo(row["channel_name"], int(row["channel_id"])),
+        (
+            _parse_time(row["created_at"])
+            if row.get("created_at") is not None
+            else datetime.now(timezone.utc)
+        ),
+        int(row["id"]),
+        _parse_time(row["edited_at"]) if row.get("edited_at") is not None else None,
+    )
+
+
+def format_message(msg: ChannelMessage) -> str:
+    return f"{msg.timestamp.isoformat(timespec='seconds')}:{msg.channel.name}:{msg.author}:{msg.content}\n"
+
+
+class MessageFormatter:
+    """
+    Formats messages as lines of text to be summarized. Subclasses may move details shared by the
+    messages in a batch into a header at the start of the batch.
+    """
+
+    def format(self, msg: ChannelMessage) -> str:
+        return format_message(msg)
+
+    def header(self, first_msg: ChannelMessage, authors: List[str]) -> str:
+        """
+        Returns the header for a batch starting with first_msg and containing messages by authors.
+        """
+        return ""
+
+    def author_entry(self, author: str) -> str:
+        """
+        Returns the part of a batch's header added for each author in the batch.
+        """
+        return ""
@@ -0,0 +1,309 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+# Upper bounds, in seconds, of the buckets of duration histograms.
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Number of recent summary runs to keep for /tldr_stats.
+RECENT_RUNS = 20
+
+_Labels = Tuple[str, ...]
+
+T = TypeVar("T")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[_Labels, float] = {}
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+
+@dataclass
+class _HistogramValues:
+    bucket_counts: List[int]
+    count: int = 0
+    sum: float = 0
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DURATION_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[_Labels, _HistogramValues] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if labels not in self.values:
+            self.values[labels] = _HistogramValues([0] * len(self.buckets))
+        values = self.values[labels]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                values.bucket_counts[i] += 1
+        values.count += 1
+        values.sum += value
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        label_names = self.labels + ("le",)
+        for labels, values in self.values.items():
+            for bound, bucket_count in zip(self.buckets, values.bucket_counts):
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(label_names, labels + (str(bound),))} {bucket_count}"
+                )
+            lines.append(
+                f"{self.name}_bucket{_format_labels(label_names, labels + ('+Inf',))} {values.count}"
+            )
+            lines.append(
+                f"{self.name}_sum{_format_labels(self.labels, labels)} {values.sum}"
+            )
+            lines.append(
+                f"{self.name}_count{_format_labels(self.labels, labels)} {values.count}"
+            )
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[Counter | Histogram] = []
+        # Called before metrics are exposed, to update gauges.
+        self.collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        counter = Counter(name, help, labels)
+        self.metrics.append(counter)
+        return counter
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        gauge = Gauge(name, help, labels)
+        self.metrics.append(gauge)
+        return gauge
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = ()) -> Histogram:
+        histogram = Histogram(name, help, labels)
+        self.metrics.append(histogram)
+        return histogram
+
+    def expose(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        for collector in self.collectors:
+            collector()
+        return "".join(
+            f"{line}\n" for metric in self.metrics for line in metric.expose()
+        )
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "tldr_stage_seconds",
+    "Time spent in each stage of summarizing: fetch, preprocess, tokenize, pack, llm, worker (waiting for worker processes) and send.",
+    ["stage"],
+)
+RUN_SECONDS = REGISTRY.histogram(
+    "tldr_run_seconds", "Duration of summary runs.", ["kind"]
+)
+LLM_TOKENS = REGISTRY.counter(
+    "tldr_llm_tokens_total",
+    "Tokens used by AI requests, as reported by the AI provider.",
+    ["model", "type"],
+)
+LLM_REQUESTS = REGISTRY.counter(
+    "tldr_llm_requests_total", "AI requests by outcome.", ["model", "outcome"]
+)
+MESSAGES = REGISTRY.counter(
+    "tldr_messages_total", "Discord messages read for summaries."
+)
+JOB_WAIT_SECONDS = REGISTRY.histogram(
+    "tldr_job_wait_seconds", "Time /tldr requests spend queued before starting."
+)
+JOBS_QUEUED = REGISTRY.gauge("tldr_jobs_queued", "Queued /tldr requests.")
+JOBS_RUNNING = REGISTRY.gauge("tldr_jobs_running", "Running /tldr requests.")
+CACHE_LOOKUPS = REGISTRY.counter(
+    "tldr_summary_cache_lookups_total", "Summary cache lookups.", ["result"]
+)
+
+
+@dataclass
+class RunStats:
+    """
+    Totals for one summary run, e.g. a periodic summary or a /tldr request.
+    """
+
+    kind: str
+    started_at: float
+    duration: float = 0
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    llm_requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    messages: int = 0
+
+    def __str__(self) -> str:
+        stages = " ".join(
+            f"{stage}={seconds:.2f}s" for stage, seconds in self.stage_seconds.items()
+        )
+        return f"kind={self.kind} duration={self.duration:.2f}s messages={self.messages} llm_requests={self.llm_requests} input_tokens={self.input_tokens} output_tokens={self.output_tokens} {stages}"
+
+
+# The run that the current task is part of, if any.
+current_run: ContextVar[Optional[RunStats]] = ContextVar("current_run", default=None)
+
+recent_runs: Deque[RunStats] = deque(maxlen=RECENT_RUNS)
+
+
+@contextmanager
+def summary_run(kind: str) -> Iterator[RunStats]:
+    """
+    Records the stages of the summary run in the block, including those of tasks it starts.
+    """
+    run = RunStats(kind, time.time())
+    token = current_run.set(run)
+    start = time.perf_counter()
+    try:
+        yield run
+    finally:
+        current_run.reset(token)
+        run.duration = time.perf_counter() - start
+        RUN_SECONDS.observe(run.duration, kind)
+        recent_runs.append(run)
+        print(f"Summary run {run}")
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage)
+    if (run := current_run.get()) is not None:
+        run.stage_seconds[stage] = run.stage_seconds.get(stage, 0) + seconds
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+async def timed_iter(stage: str, iterable: AsyncIterable[T]) -> AsyncIterator[T]:
+    """
+    Yields the items of iterable, recording the time spent waiting for them, but not the time spent
+    by the caller between items, as stage.
+    """
+    seconds = 0.0
+    iterator = aiter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - start
+            yield item
+    finally:
+        record_stage(stage, seconds)
+
+
+def record_messages(count: int) -> None:
+    MESSAGES.inc(count)
+    if (run := current_run.get()) is not None:
+        run.messages += count
+
+
+def record_llm_request(
+    model: str, outcome: str, input_tokens: int = 0, output_tokens: int = 0
+) -> None:
+    LLM_REQUESTS.inc(1, model, outcome)
+    LLM_TOKENS.inc(input_tokens, model, "input")
+    LLM_TOKENS.inc(output_tokens, model, "output")
+    if (run := current_run.get()) is not None:
+        run.llm_requests += 1
+        run.input_tokens += input_tokens
+        run.output_tokens += output_tokens
+
+
+async def serve(port: int, registry: Registry = REGISTRY) -> asyncio.Server:
+    """
+    Serves registry's metrics at http://127.0.0.1:port/metrics.
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers.
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+                status = "200 OK"
+                body = registry.expose().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", port)
@@ -0,0 +1,142 @@
+import json
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from .config import RoutingPolicy
+
+# At the time of writing, this is the smallest token limit of non-deprecated GPT models.
+DEFAULT_CONTEXT_WINDOW = 4096
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    name: str
+    context_window: int
+    max_output_tokens: int
+    # US dollars per million tokens.
+    input_price: float
+    output_price: float
+    # Typical rate at which output is generated.
+    output_tokens_per_second: float
+
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        return (
+            input_tokens * self.input_price + output_tokens * self.output_price
+        ) / 1_000_000
+
+    def latency(self, output_tokens: int) -> float:
+        return output_tokens / self.output_tokens_per_second
+
+
+MODELS: Dict[str, ModelInfo] = {
+    info.name: info
+    for info in [
+        ModelInfo("gpt-3.5-turbo", 16385, 4096, 0.5, 1.5, 80),
+        ModelInfo("gpt-3.5-turbo-1106", 16385, 4096, 1.0, 2.0, 80),
+        ModelInfo("gpt-4", 8192, 8192, 30.0, 60.0, 20),
+        ModelInfo("gpt-4-1106-preview", 128000, 4096, 10.0, 30.0, 30),
+        ModelInfo("gpt-4-turbo", 128000, 4096, 10.0, 30.0, 30),
+        ModelInfo("gpt-4o", 128000, 16384, 2.5, 10.0, 80),
+        ModelInfo("gpt-4o-mini", 128000, 16384, 0.15, 0.6, 100),
+    ]
+}
+
+
+def load_models(path: str) -> None:
+    """
+    Adds models to, or replaces models in, the registry from a JSON list of ModelInfo fields.
+    """
+    with open(path) as f:
+        for fields in json.load(f):
+            info = ModelInfo(**fields)
+            MODELS[info.name] = info
+
+
+def model_info(name: str) -> ModelInfo:
+    """
+    Returns the registered model name, or else the registered model that name is the longest
+    dated version of, e.g. gpt-4 for gpt-4-0613. Unknown models are assumed to have the smallest
+    context window, and no known price or speed.
+    """
+    if name in MODELS:
+        return MODELS[name]
+    prefixes = [known for known in MODELS if name.startswith(f"{known}-")]
+    if prefixes:
+        return MODELS[max(prefixes, key=len)]
+    print(
+        f"Unknown model {name}, assuming a context window of {DEFAULT_CONTEXT_WINDOW}"
+    )
+    return ModelInfo(
+        name,
+        DEFAULT_CONTEXT_WINDOW,
+        DEFAULT_CONTEXT_WINDOW,
+        float("inf"),
+        float("inf"),
+        float("inf"),
+    )
+
+
+class ModelRouter:
+    """
+    Chooses which of models to send each request to. Requests go to the cheapest or the fastest
+    model whose context window fits them, or always to the first model if the policy is fixed.
+    overhead_tokens is the number of input tokens used by each request in addition to its
+    messages, such as the prompt.
+    """
+
+    def __init__(
+        self,
+        models: List[str],
+        policy: RoutingPolicy,
+        output_tokens: int,
+        overhead_tokens: int,
+    ):
+        self.models = [model_info(model) for model in models]
+        self.policy = policy
+        self.output_tokens = output_tokens
+        self.overhead_tokens = overhead_tokens
+        for model in self.models:
+            if output_tokens > model.max_output_tokens:
+                raise Exception(
+                    f"MAX_OUTPUT_TOKENS={output_tokens} is more than {model.name} can produce: {model.max_output_tokens}"
+                )
+        if policy is not RoutingPolicy.fixed and any(
+            model.input_price == float("inf") for model in self.models
+        ):
+            raise Exception(
+                "Routing requires the price and speed of each model. Add them with MODEL_REGISTRY_PATH."
+            )
+
+    @property
+    def max_input_tokens(self) -> int:
+        """
+        The most message tokens that any model can take in one request.
+        """
+        if self.policy is RoutingPolicy.fixed:
+            context_window = self.models[0].context_window
+        else:
+            context_window = max(model.context_window for model in self.models)
+        return context_window - self.overhead_tokens - self.output_tokens
+
+    def route(self, num_tokens: Optional[int]) -> ModelInfo:
+        """
+        Returns the model to send a request with num_tokens message tokens to. If num_tokens is
+        unknown, it is assumed to be as large as any model allows.
+        """
+        if self.policy is RoutingPolicy.fixed:
+            return self.models[0]
+        input_tokens = (
+            num_tokens if num_tokens is not None else self.max_input_tokens
+        ) + self.overhead_tokens
+        fits = [
+            model
+            for model in self.models
+            if input_tokens + self.output_tokens <= model.context_window
+        ]
+        if not fits:
+            return max(self.models, key=lambda model: model.context_window)
+        if self.policy is RoutingPolicy.cheapest:
+            return min(
+                fits, key=lambda model: model.cost(input_tokens, self.output_tokens)
+            )
+        return min(fits, key=lambda model: model.latency(self.output_tokens))
@@ -1,63 +1,138 @@
-from typing import List
+from typing import AsyncIterator, List, Optional
 
-import tiktoken
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, RateLimitError
 
-from .config import AIConfig
-from .summarizer import Summarizer
+from . import metrics
+from .config import AIConfig, RoutingPolicy
+from .models import ModelRouter, load_models
+from .summarizer import RateLimited, Summarizer, load_encoding
 
 # Due to uncertainty around the way that OpenAI tokenizes text server-side, include a pessemistic buffer.
 OPENAI_TOKEN_BUFFER = 100
 
-MODEL_TO_MAX_TOKENS = {
-    "gpt-3.5-turbo-1106": 16385,
-    "gpt-4": 8192,
-    "gpt-4-1106-preview": 128000,
-}
+
+def chat_request(
+    config: AIConfig,
+    messages: List[str],
+    prompt: Optional[str],
+    model: Optional[str] = None,
+) -> dict:
+    """
+    Returns the body of a chat completion request summarizing messages, sent to model, which
+    defaults to config.model.
+    """
+    return {
+        "max_tokens": config.max_output_tokens,
+        "model": model or config.model,
+        "messages": [
+            {
+                "role": "system",
+                "content": prompt or config.prompt,
+            },
+            {
+                "role": "user",
+                "content": "".join(messages),
+            },
+        ],
+    }
 
 
 class SummaryClient(AsyncOpenAI, Summarizer):
     def __init__(self, config: AIConfig, *args, **kwargs):
         Summarizer.__init__(self, config)
         AsyncOpenAI.__init__(self, *args, **kwargs)
-        self.encoding = tiktoken.encoding_for_model(config.model)
+        self.encoding = load_encoding(config.model)
+        if config.model_registry_path:
+            load_models(config.model_registry_path)
+        self.router = ModelRouter(
+            (
+                [config.model]
+                if config.routing_policy is RoutingPolicy.fixed
+                else config.models
+            ),
+            config.routing_policy,
+            config.max_output_tokens,
+            max(
+                len(self.encoding.encode(config.prompt)),
+                len(self.encoding.encode(config.combine_prompt)),
+            )
+            + OPENAI_TOKEN_BUFFER,
+        )
         self.max_msg_tokens = self._max_msg_tokens()
 
-    async def summarize(self, messages: List[str]) -> str:
-        response = await self.chat.completions.create(
-            max_tokens=self.config.max_output_tokens,
-            model=self.config.model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": self.config.prompt,
-                },
-                {
-                    "role": "user",
-                    "content": "".join(messages),
-                },
-            ],
-        )
+    def model_for(self, messages: List[str], num_tokens: Optional[int] = None) -> str:
+        if num_tokens is None and self.config.routing_policy is not RoutingPolicy.fixed:
+            num_tokens = len(self.encoding.encode_ordinary("".join(messages)))
+        return self.router.route(num_tokens).name
+
+    async def summarize(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> str:
+        model = self.model_for(messages, num_tokens)
+        try:
+            with metrics.timed("llm"):
+                response = await self.chat.completions.create(
+                    **chat_request(self.config, messages, prompt, model),
+                )
+        except RateLimitError as e:
+            metrics.record_llm_request(model, "rate_limited")
+            retry_after = e.response.headers.get("retry-after")
+            raise RateLimited(float(retry_after) if retry_after else None) from e
+        except Exception:
+            metrics.record_llm_request(model, "error")
+            raise
 
+        metrics.record_llm_request(
+            model,
+            "ok",
+            response.usage.prompt_tokens if response.usage else 0,
+            response.usage.completion_tokens if response.usage else 0,
+        )
         if (content := response.choices[0].message.content) is None:
             raise Exception("Received no content.")
         return content
 
+    async def summarize_stream(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        model = self.model_for(messages, num_tokens)
+        try:
+            with metrics.timed("llm"):
+                stream = await self.chat.completions.create(
+                    **chat_request(self.config, messages, prompt, model),
+                    stream=True,
+                    # The last chunk then reports token usage.
+                    stream_options={"include_usage": True},
+                )
+        except RateLimitError as e:
+            metrics.record_llm_request(model, "rate_limited")
+            retry_after = e.response.headers.get("retry-after")
+            raise RateLimited(float(retry_after) if retry_after else None) from e
+        except Exception:
+            metrics.record_llm_request(model, "error")
+            raise
+
+        input_tokens = output_tokens = 0
+        async for chunk in metrics.timed_iter("llm", stream):
+            if chunk.usage:
+                input_tokens = chunk.usage.prompt_tokens
+                output_tokens = chunk.usage.completion_tokens
+            if chunk.choices and (content := chunk.choices[0].delta.content):
+                yield content
+        metrics.record_llm_request(model, "ok", input_tokens, output_tokens)
+
     def _max_msg_tokens(self) -> int:
-        max_tokens_for_model = MODEL_TO_MAX_TOKENS[self.config.model]
-        if not max_tokens_for_model:
-            # At the time of writing, this is the smallest token limit non-deprecated GPT models
-            max_tokens_for_model = 4096
-        base_tokens_amount = (
-            len(self.encoding.encode(self.config.prompt))
-            + self.config.max_output_tokens
-            + OPENAI_TOKEN_BUFFER
-        )
-        res = max_tokens_for_model - base_tokens_amount
+        res = self.router.max_input_tokens
         # Arbitrary, but avoid max_output_tokens being far too high for the choice of model
         min_input_tokens = 500
         if res < min_input_tokens:
             raise Exception(
-                f"Too few tokens allocated for input. max_tokens_for_model={max_tokens_for_model}, max_output_tokens={self.config.max_output_tokens}, input_tokens={res}. max_tokens_for_model - max_output_tokens must be greater than {min_input_tokens}"
+                f"Too few tokens allocated for input. max_output_tokens={self.config.max_output_tokens}, input_tokens={res}. The model's context window minus max_output_tokens must be greater than {min_input_tokens}"
             )
         return res
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from discord import Embed, Message, TextChannel
+
+from . import metrics
+from .live_message import MAX_MESSAGE_LENGTH
+
+# Discord's limits on embeds.
+MAX_EMBED_DESCRIPTION_LENGTH = 4096
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBEDS_LENGTH = 6000
+
+# Separates pieces of output packed into the same message.
+SEPARATOR = "\n\n"
+
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Splits text into pieces of at most limit characters, at line boundaries where possible, then at
+    spaces.
+    """
+    pieces = []
+    while len(text) > limit:
+        split_at = text.rfind("\n", 0, limit + 1)
+        if split_at <= 0:
+            split_at = text.rfind(" ", 0, limit + 1)
+        if split_at <= 0:
+            split_at = limit
+        pieces.append(text[:split_at].rstrip())
+        text = text[split_at:].lstrip("\n ")
+    if text.strip():
+        pieces.append(text)
+    return pieces
+
+
+class PacedSender:
+    """
+    Sends messages to each channel in order, at most one every min_interval seconds, to stay within
+    Discord's per-channel rate limit rather than running into it and waiting.
+    """
+
+    def __init__(self, min_interval: float = 1.0):
+        self.min_interval = min_interval
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._sent_at: Dict[int, float] = {}
+
+    async def send(
+        self,
+        channel: TextChannel,
+        content: Optional[str] = None,
+        embeds: Optional[List[Embed]] = None,
+    ) -> Message:
+        lock = self._locks.setdefault(channel.id, asyncio.Lock())
+        # asyncio.Lock wakes waiters in order, so messages are sent in the order they were queued.
+        async with lock:
+            wait = (
+                self._sent_at.get(channel.id, 0) + self.min_interval - time.monotonic()
+            )
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                with metrics.timed("send"):
+                    if embeds:
+                        return await channel.send(content, embeds=embeds)
+                    return await channel.send(content)
+            finally:
+                self._sent_at[channel.id] = time.monotonic()
+
+
+class OutputComposer:
+    """
+    Packs pieces of output, such as headers and summaries, into as few Discord messages as fit them,
+    as plain messages or embeds. A message is sent as soon as it is full, and the rest when flushed.
+    """
+
+    def __init__(
+        self, channel: TextChannel, sender: PacedSender, use_embeds: bool = False
+    ):
+        self.channel = channel
+        self.sender = sender
+        self.use_embeds = use_embeds
+        self.block_limit = (
+            MAX_EMBED_DESCRIPTION_LENGTH if use_embeds else MAX_MESSAGE_LENGTH
+        )
+        # The block being filled, and full blocks not yet sent, which are only held back when
+        # several can be sent as embeds of one message.
+        self._block = ""
+        self._full_blocks: List[str] = []
+
+    async def add(self, text: str) -> None:
+        for piece in split_text(text, self.block_limit):
+            if not self._block:
+                self._block = piece
+            elif len(self._block) + len(SEPARATOR) + len(piece) <= self.block_limit:
+                self._block += SEPARATOR + piece
+            else:
+                await self._seal()
+                self._block = piece
+
+    async def flush(self) -> None:
+        if self._block:
+            await self._seal()
+        if self._full_blocks:
+            await self._send_embeds(self._full_blocks)
+            self._full_blocks = []
+
+    async def _seal(self) -> None:
+        block, self._block = self._block, ""
+        if not self.use_embeds:
+            await self.sender.send(self.channel, block)
+            return
+        if (
+            len(self._full_blocks) >= MAX_EMBEDS_PER_MESSAGE
+            or sum(map(len, self._full_blocks)) + len(block) > MAX_EMBEDS_LENGTH
+        ):
+            await self._send_embeds(self._full_blocks)
+            self._full_blocks = []
+        self._full_blocks.append(block)
+
+    async def _send_embeds(self, blocks: List[str]) -> None:
+        await self.sender.send(
+            self.channel, embeds=[Embed(description=block) for block in blocks]
+        )
@@ -0,0 +1,216 @@
+import asyncio
+import time
+from collections import deque
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Collection,
+    Deque,
+    List,
+    Optional,
+    Union,
+)
+
+from . import metrics
+from .batcher import Batch, MessageBatcher
+from .config import PreprocessStep
+from .messages import ChannelMessage, format_message
+from .preprocess import Preprocessor
+from .summarizer import Summarizer
+from .token_counter import TokenCounter
+
+# Discord returns channel history in pages of at most 100 messages.
+DISCORD_PAGE_SIZE = 100
+
+# Sentinel marking the end of a stage's output.
+_DONE = object()
+
+_PageQueue = asyncio.Queue[Union[List[ChannelMessage], BaseException, object]]
+_BatchQueue = asyncio.Queue[Union[Batch, BaseException, object]]
+
+
+class SummaryPipeline:
+    """
+    Streams channel history through three stages - fetch, batch and summarize - connected by bounded
+    queues. A slow stage applies backpressure to the stages before it, so at most
+    max_pending_pages pages of messages and max_pending_batches batches are held in memory at once.
+    """
+
+    def __init__(
+        self,
+        summarizer: Summarizer,
+        min_messages: int = 0,
+        concurrency: int = 1,
+        token_counter: Optional[TokenCounter] = None,
+        preprocess_steps: Collection[PreprocessStep] = (),
+        max_pending_pages: int = 4,
+        max_pending_batches: int = 2,
+    ):
+        self.summarizer = summarizer
+        self.min_messages = min_messages
+        self.concurrency = concurrency
+        self.token_counter = token_counter
+        self.preprocess_steps = preprocess_steps
+        self.max_pending_pages = max_pending_pages
+        self.max_pending_batches = max_pending_batches
+        # Populated as the pipeline runs.
+        self.num_messages = 0
+        self.skipped = False
+        # Tokens in batches, and tokens the messages would have taken without preprocessing.
+        self.num_tokens = 0
+        self.original_tokens = 0
+
+    async def batches(
+        self, history: AsyncIterable[ChannelMessage]
+    ) -> AsyncIterator[Batch]:
+        """
+        Yields batches as soon as they fill the summarizer's token budget. If history contains fewer
+        than self.min_messages messages, nothing is yielded and self.skipped is set.
+        """
+        pages: _PageQueue = asyncio.Queue(self.max_pending_pages)
+        batches: _BatchQueue = asyncio.Queue(self.max_pending_batches)
+        tasks = [
+            asyncio.create_task(self._fetch(history, pages)),
+            asyncio.create_task(self._batch(pages, batches)),
+        ]
+        try:
+            while (item := await batches.get()) is not _DONE:
+                if isinstance(item, BaseException):
+                    raise item
+                assert isinstance(item, Batch)
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def summaries(
+        self, history: AsyncIterable[ChannelMessage]
+    ) -> AsyncIterator[str]:
+        """
+        Yields one summary per batch, in message order.
+        """
+        async for _, summary in self.summarized_batches(history):
+            yield summary
+
+    async def summarized_batches(
+        self, history: AsyncIterable[ChannelMessage]
+    ) -> AsyncIterator[tuple[Batch, str]]:
+        """
+        Yields each batch along with its summary, in message order. Up to self.concurrency batches
+        are summarized at once.
+        """
+        pending: Deque[tuple[Batch, asyncio.Task[str]]] = deque()
+        try:
+            async for batch in self.batches(history):
+                pending.append(
+                    (
+                        batch,
+                        asyncio.create_task(
+                            self.summarizer.summarize(
+                                batch.messages, num_tokens=batch.num_tokens
+                            )
+                        ),
+                    )
+                )
+                if len(pending) >= self.concurrency:
+                    batch, task = pending.popleft()
+                    yield batch, await task
+            while pending:
+                batch, task = pending.popleft()
+                yield batch, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def _fetch(
+        self,
+        history: AsyncIterable[ChannelMessage],
+        pages: _PageQueue,
+    ) -> None:
+        try:
+            # Hold messages back until it is known that there are at least self.min_messages of them.
+            page_size = max(DISCORD_PAGE_SIZE, self.min_messages)
+            page: List[ChannelMessage] = []
+            fetch_start = time.perf_counter()
+            async for msg in history:
+                page.append(msg)
+                self.num_messages += 1
+                if len(page) >= page_size:
+                    # Time spent waiting for the page, but not for it to be batched.
+                    metrics.record_stage("fetch", time.perf_counter() - fetch_start)
+                    metrics.record_messages(len(page))
+                    await pages.put(page)
+                    fetch_start = time.perf_counter()
+                    page = []
+                    page_size = DISCORD_PAGE_SIZE
+            metrics.record_stage("fetch", time.perf_counter() - fetch_start)
+            metrics.record_messages(len(page))
+            if self.num_messages < self.min_messages:
+                self.skipped = True
+            elif page:
+                await pages.put(page)
+            await pages.put(_DONE)
+        except Exception as e:
+            await pages.put(e)
+
+    async def _batch(
+        self,
+        pages: _PageQueue,
+        batches: _BatchQueue,
+    ) -> None:
+        try:
+            preprocessor = Preprocessor(self.preprocess_steps)
+            batcher = MessageBatcher(
+                self.summarizer.encoding,
+                self.summarizer.max_msg_tokens,
+                preprocessor.formatter,
+            )
+            while (page := await pages.get()) is not _DONE:
+                if isinstance(page, BaseException):
+                    raise page
+                assert isinstance(page, list)
+                if self.preprocess_steps:
+                    formatted_msgs = [format_message(msg) for msg in page]
+                    self.original_tokens += sum(await self._count(page, formatted_msgs))
+                    with metrics.timed("preprocess"):
+                        page = preprocessor.process(page)
+                for batch in await self._add(batcher, page):
+                    await batches.put(batch)
+            for batch in await self._add(batcher, preprocessor.flush()):
+                await batches.put(batch)
+            with metrics.timed("pack"):
+                final_batch = batcher.flush()
+            if final_batch is not None:
+                self.num_tokens += final_batch.num_tokens
+                await batches.put(final_batch)
+            await batches.put(_DONE)
+        except Exception as e:
+            await batches.put(e)
+
+    async def _add(
+        self, batcher: MessageBatcher, messages: List[ChannelMessage]
+    ) -> List[Batch]:
+        # Formatting and packing count as one stage, either side of tokenizing.
+        start = time.perf_counter()
+        formatted_msgs = [batcher.formatter.format(msg) for msg in messages]
+        format_time = time.perf_counter() - start
+        msg_tokens = await self._count(messages, formatted_msgs)
+        start = time.perf_counter()
+        completed = batcher.add_counted(messages, formatted_msgs, msg_tokens)
+        metrics.record_stage("pack", format_time + time.perf_counter() - start)
+        self.num_tokens += sum(batch.num_tokens for batch in completed)
+        return completed
+
+    async def _count(
+        self, messages: List[ChannelMessage], formatted_msgs: List[str]
+    ) -> List[int]:
+        with metrics.timed("tokenize"):
+            if self.token_counter is not None:
+                return await self.token_counter.count(messages, formatted_msgs)
+            # encode_ordinary does not raise on special tokens, e.g. a user typing <|endoftext|>.
+            return [
+                len(tokens)
+                for tokens in self.summarizer.encoding.encode_ordinary_batch(
+                    formatted_msgs
+                )
+            ]
@@ -0,0 +1,121 @@
+import re
+from dataclasses import replace
+from datetime import datetime, timedelta
+from typing import Collection, List, Optional
+
+from .config import PreprocessStep
+from .messages import ChannelMessage, MessageFormatter
+
+URL_PATTERN = re.compile(r"https?://(?:www\.)?([^/\s>]+)[^\s>]*")
+CODE_BLOCK_PATTERN = re.compile(r"```.*?```", re.DOTALL)
+CUSTOM_EMOJI_PATTERN = re.compile(r"<a?(:\w+:)\d+>")
+REPEATED_EMOJI_PATTERN = re.compile(
+    r"(:\w+:|[\U0001F000-\U0001FAFF\u2600-\u27BF]\uFE0F?)(?:\s*\1)+"
+)
+# Consecutive messages from the same author are only merged if sent within this time of each other.
+MERGE_WINDOW = timedelta(minutes=5)
+
+
+class CompactFormatter(MessageFormatter):
+    """
+    Formats messages without the channel name, which is instead given once in each batch's header,
+    and with timestamps as minutes since the first message. Optionally, authors are abbreviated
+    and listed in the header.
+    """
+
+    def __init__(self, abbreviate_authors: bool):
+        self._start: Optional[datetime] = None
+        self._aliases: Optional[dict[str, str]] = {} if abbreviate_authors else None
+
+    def format(self, msg: ChannelMessage) -> str:
+        if self._start is None:
+            self._start = msg.timestamp
+        minutes = int((msg.timestamp - self._start).total_seconds() // 60)
+        return f"{minutes}:{self._alias(msg.author)}:{msg.content}\n"
+
+    def header(self, first_msg: ChannelMessage, authors: List[str]) -> str:
+        assert self._start is not None
+        header = f"Messages from #{first_msg.channel.name}, formatted as minutes since {self._start.isoformat(timespec='minutes')}:author:content.\n"
+        if self._aliases is not None:
+            entries = "".join(self.author_entry(author) for author in authors)
+            header += (
+                f"Authors are abbreviated, always use their full names:{entries}\n"
+            )
+        return header
+
+    def author_entry(self, author: str) -> str:
+        alias = self._alias(author)
+        return f" {alias}={author}" if alias != author else ""
+
+    def _alias(self, author: str) -> str:
+        if self._aliases is None:
+            return author
+        if author not in self._aliases:
+            alias = f"U{len(self._aliases) + 1}"
+            # Only abbreviate names that are longer than their abbreviation.
+            self._aliases[author] = alias if len(alias) < len(author) else author
+        return self._aliases[author]
+
+
+class Preprocessor:
+    """
+    Reduces the number of tokens needed to summarize messages, by rewriting messages before they
+    are batched and by choosing a more compact formatter. Messages are processed in order, a page
+    at a time, so a new Preprocessor is needed for each sequence of messages.
+    """
+
+    def __init__(self, steps: Collection[PreprocessStep]):
+        self.steps = steps
+        self.formatter = (
+            CompactFormatter(PreprocessStep.abbreviate_authors in steps)
+            if PreprocessStep.compact in steps
+            else MessageFormatter()
+        )
+        # The last message is held back until it is known that the next message will not be merged
+        # into it.
+        self._held: Optional[ChannelMessage] = None
+
+    def process(self, messages: List[ChannelMessage]) -> List[ChannelMessage]:
+        processed: List[ChannelMessage] = []
+        for msg in messages:
+            msg = replace(msg, content=self._clean(msg.content))
+            if PreprocessStep.merge not in self.steps:
+                processed.append(msg)
+            elif self._held is None:
+                self._held = msg
+            elif (
+                msg.author == self._held.author
+                and msg.timestamp - self._held.timestamp < MERGE_WINDOW
+            ):
+                self._held = replace(
+                    self._held,
+                    content=f"{self._held.content}\n{msg.content}",
+                    edited_at=max(
+                        (t for t in (self._held.edited_at, msg.edited_at) if t),
+                        default=None,
+                    ),
+                )
+            else:
+                processed.append(self._held)
+                self._held = msg
+        return processed
+
+    def flush(self) -> List[ChannelMessage]:
+        """
+        Returns any message held back by process.
+        """
+        held, self._held = self._held, None
+        return [held] if held is not None else []
+
+    def _clean(self, content: str) -> str:
+        if PreprocessStep.code in self.steps:
+            content = CODE_BLOCK_PATTERN.sub(
+                lambda m: f"[code block, {m.group().count(chr(10)) + 1} lines]",
+                content,
+            )
+        if PreprocessStep.urls in self.steps:
+            content = URL_PATTERN.sub(r"<\1 link>", content)
+        if PreprocessStep.emoji in self.steps:
+            content = CUSTOM_EMOJI_PATTERN.sub(r"\1", content)
+            content = REPEATED_EMOJI_PATTERN.sub(r"\1", content)
+        return content
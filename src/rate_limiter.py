@@ -0,0 +1,205 @@
+import asyncio
+import heapq
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+from itertools import count
+from typing import AsyncIterator, List, Optional
+
+from . import metrics
+from .summarizer import RateLimited, Summarizer
+
+
+class Priority(IntEnum):
+    # Lower values are sent first.
+    interactive = 0
+    background = 1
+
+
+# Priority of summaries requested from the current task, e.g. background for periodic summaries.
+request_priority: ContextVar[Priority] = ContextVar(
+    "request_priority", default=Priority.interactive
+)
+
+
+def scaled_limit(per_minute: Optional[int], fraction: float) -> Optional[int]:
+    """
+    Returns fraction of the limit per_minute, which may be None for no limit.
+    """
+    return max(1, int(per_minute * fraction)) if per_minute else None
+
+
+class TokenBucket:
+    """
+    Allows up to per_minute units per minute, refilled continuously. A per_minute of None means no
+    limit.
+    """
+
+    def __init__(self, per_minute: Optional[int]):
+        self.capacity = float(per_minute) if per_minute else float("inf")
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+
+    def set_limit(self, per_minute: Optional[int]) -> None:
+        self._refill()
+        self.capacity = float(per_minute) if per_minute else float("inf")
+        self.available = min(self.available, self.capacity)
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Seconds until amount units are available.
+        """
+        self._refill()
+        # Requests larger than the bucket would otherwise never be sent.
+        amount = min(amount, self.capacity)
+        if amount <= self.available:
+            return 0
+        return (amount - self.available) * 60 / self.capacity
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.capacity != float("inf"):
+            self.available = min(
+                self.capacity,
+                self.available + (now - self.updated_at) * self.capacity / 60,
+            )
+        self.updated_at = now
+
+
+class RateLimitedSummarizer(Summarizer):
+    """
+    Wraps a Summarizer so that requests stay within the AI provider's requests-per-minute and
+    tokens-per-minute limits. Waiting requests are sent in order of request_priority, so that
+    interactive requests go ahead of background work. Requests that are rate limited anyway are
+    retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        summarizer: Summarizer,
+        requests_per_minute: Optional[int],
+        tokens_per_minute: Optional[int],
+        max_retries: int = 5,
+    ):
+        Summarizer.__init__(self, summarizer.config)
+        self.summarizer = summarizer
+        self.encoding = summarizer.encoding
+        self.max_msg_tokens = summarizer.max_msg_tokens
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        # Heap of (priority, arrival order, tokens, future resolved when the request may be sent).
+        self._waiting: List[tuple[Priority, int, int, asyncio.Future[None]]] = []
+        self._arrivals = count()
+        self._arrived = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task[None]] = None
+        self._paused_until = 0.0
+        self._prompt_tokens: dict[str, int] = {}
+
+    async def summarize(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> str:
+        request_tokens = self._request_tokens(messages, prompt, num_tokens)
+        for attempt in range(self.max_retries + 1):
+            with metrics.timed("rate_limit_wait"):
+                await self._acquire(request_tokens, request_priority.get())
+            try:
+                return await self.summarizer.summarize(messages, prompt, num_tokens)
+            except RateLimited as e:
+                if attempt == self.max_retries:
+                    raise
+                self._back_off(e, attempt)
+        raise AssertionError("unreachable")
+
+    def set_limits(
+        self, requests_per_minute: Optional[int], tokens_per_minute: Optional[int]
+    ) -> None:
+        """
+        Changes the limits, e.g. as other processes sharing them start and stop.
+        """
+        self.requests.set_limit(requests_per_minute)
+        self.tokens.set_limit(tokens_per_minute)
+        # Waiting requests may now be sent sooner.
+        self._arrived.set()
+
+    def model_for(self, messages: List[str], num_tokens: Optional[int] = None) -> str:
+        return self.summarizer.model_for(messages, num_tokens)
+
+    async def summarize_stream(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        request_tokens = self._request_tokens(messages, prompt, num_tokens)
+        for attempt in range(self.max_retries + 1):
+            with metrics.timed("rate_limit_wait"):
+                await self._acquire(request_tokens, request_priority.get())
+            try:
+                async for piece in self.summarizer.summarize_stream(
+                    messages, prompt, num_tokens
+                ):
+                    yield piece
+                return
+            except RateLimited as e:
+                # Rate limits are reported before any content is streamed.
+                if attempt == self.max_retries:
+                    raise
+                self._back_off(e, attempt)
+
+    def _request_tokens(
+        self, messages: List[str], prompt: Optional[str], num_tokens: Optional[int]
+    ) -> int:
+        if num_tokens is None:
+            num_tokens = sum(map(len, self.encoding.encode_ordinary_batch(messages)))
+        prompt = prompt or self.config.prompt
+        if prompt not in self._prompt_tokens:
+            self._prompt_tokens[prompt] = len(self.encoding.encode_ordinary(prompt))
+        return num_tokens + self._prompt_tokens[prompt] + self.config.max_output_tokens
+
+    def _back_off(self, e: RateLimited, attempt: int) -> None:
+        backoff = e.retry_after or min(2**attempt, 60)
+        print(f"Rate limited by AI provider, retrying in {backoff} seconds")
+        self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+
+    async def _acquire(self, request_tokens: int, priority: Priority) -> None:
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._waiting, (priority, next(self._arrivals), request_tokens, future)
+        )
+        self._arrived.set()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self) -> None:
+        while self._waiting:
+            _, _, request_tokens, future = self._waiting[0]
+            if future.done():
+                # The waiting request was cancelled.
+                heapq.heappop(self._waiting)
+                continue
+            delay = max(
+                self._paused_until - time.monotonic(),
+                self.requests.wait_time(1),
+                self.tokens.wait_time(request_tokens),
+            )
+            if delay > 0:
+                # Wake early if a request arrives, as it may have a higher priority.
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._waiting)
+            self.requests.take(1)
+            self.tokens.take(request_tokens)
+            future.set_result(None)
@@ -0,0 +1,253 @@
+import abc
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+
+# Seconds to wait before retrying a scheduled summary that failed.
+RETRY_DELAY = 300
+
+
+class Schedule(abc.ABC):
+    @abc.abstractmethod
+    def next_after(self, last_run: datetime) -> datetime:
+        pass
+
+
+class IntervalSchedule(Schedule):
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+
+    def next_after(self, last_run: datetime) -> datetime:
+        return last_run + timedelta(seconds=self.seconds)
+
+
+# The most days in each month, in leap years.
+MAX_MONTH_DAYS = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def _parse_cron_field(value: str, low: int, high: int) -> set[int]:
+    values: set[int] = set()
+    for part in value.split(","):
+        range_part, _, step = part.partition("/")
+        if range_part == "*":
+            start, end = low, high
+        elif "-" in range_part:
+            start, end = map(int, range_part.split("-"))
+        else:
+            start = int(range_part)
+            end = high if step else start
+        if not low <= start <= end <= high:
+            raise Exception(f"Invalid cron field: {value}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class CronSchedule(Schedule):
+    """
+    A schedule given as a standard five-field cron expression, e.g. "0 9 * * 1-5", in UTC.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise Exception(f"Cron expression must have five fields: {expression}")
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        # Both 0 and 7 mean Sunday.
+        self.weekdays = {d % 7 for d in _parse_cron_field(fields[4], 0, 7)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+        # Every month has every weekday, so only days of the month restricted on their own can
+        # fail to match, e.g. "0 0 30 2 *", which would otherwise search for a run forever.
+        if self.any_weekday and min(self.days) > max(
+            MAX_MONTH_DAYS[month - 1] for month in self.months
+        ):
+            raise Exception(f"Cron expression never matches a date: {expression}")
+
+    def next_after(self, last_run: datetime) -> datetime:
+        t = last_run.astimezone(timezone.utc).replace(
+            second=0, microsecond=0
+        ) + timedelta(minutes=1)
+        # Skip ahead by the largest unit that doesn't match, so that this takes at most a few
+        # hundred iterations.
+        while True:
+            if t.month not in self.months:
+                t = (t.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+            elif not self._day_matches(t):
+                t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+            elif t.hour not in self.hours:
+                t = (t + timedelta(hours=1)).replace(minute=0)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+
+    def _day_matches(self, t: datetime) -> bool:
+        day = t.day in self.days
+        # Cron weekdays count from Sunday, Python's from Monday.
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        # As in cron, if both are restricted then either may match.
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def parse_schedule(spec: dict) -> Schedule:
+    """
+    Parses {"interval": seconds} or {"cron": expression}.
+    """
+    if "cron" in spec:
+        return CronSchedule(spec["cron"])
+    return IntervalSchedule(int(spec["interval"]))
+
+
+@dataclass
+class ScheduledSummary:
+    # Used to persist the time of the last run.
+    key: str
+    schedule: Schedule
+    # Channels to summarize. If None, all channels except those in exclude_channel_ids.
+    channel_ids: Optional[List[int]] = None
+    exclude_channel_ids: List[int] = field(default_factory=list)
+
+
+def load_scheduled_summaries(
+    default_schedule: Schedule, path: Optional[str]
+) -> List[ScheduledSummary]:
+    """
+    Returns the server-wide summary on default_schedule, plus a summary for each channel given a
+    schedule of its own in the JSON file at path, e.g. {"1234": {"interval": 3600}}. Channels with
+    their own schedule are left out of the server-wide summary.
+    """
+    channel_schedules: dict[str, dict] = {}
+    if path:
+        with open(path) as f:
+            channel_schedules = json.load(f)
+    return [
+        ScheduledSummary(
+            "server",
+            default_schedule,
+            exclude_channel_ids=[int(channel_id) for channel_id in channel_schedules],
+        )
+    ] + [
+        ScheduledSummary(
+            f"channel:{channel_id}", parse_schedule(spec), [int(channel_id)]
+        )
+        for channel_id, spec in channel_schedules.items()
+    ]
+
+
+class SummaryScheduler:
+    """
+    Runs scheduled summaries while active. The scheduler sleeps until the next summary is due, or
+    until it is activated or deactivated. Whether it is active and when each summary last ran are
+    saved to state_path, if given, so that they survive restarts.
+    """
+
+    def __init__(
+        self,
+        summaries: List[ScheduledSummary],
+        active: bool,
+        state_path: Optional[str] = None,
+    ):
+        self.summaries = summaries
+        self.state_path = state_path
+        self.active = active
+        self.last_runs: dict[str, float] = {}
+        # Summaries whose last run failed, and when to retry them. Not saved, so failed summaries
+        # are retried on restart.
+        self.retry_at: dict[str, datetime] = {}
+        self._changed = asyncio.Event()
+        if state_path and os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            self.active = state["active"]
+            self.last_runs = state["last_runs"]
+
+    @property
+    def has_state(self) -> bool:
+        return bool(self.last_runs)
+
+    def set_active(self, active: bool) -> None:
+        self.active = active
+        self._save()
+        self._changed.set()
+
+    def set_last_run(self, key: str, last_run: float) -> None:
+        self.last_runs[key] = last_run
+        self._save()
+
+    def next_run(self) -> tuple[ScheduledSummary, datetime]:
+        """
+        Returns the summary that is due next and when it is due.
+        """
+        return min(
+            ((summary, self._next_run_time(summary)) for summary in self.summaries),
+            key=lambda pair: pair[1],
+        )
+
+    async def run(
+        self, callback: Callable[[ScheduledSummary, datetime], Awaitable[bool]]
+    ) -> None:
+        """
+        Forever, calls callback with each summary when it is due and the time it last ran.
+        callback returns whether the summary succeeded. A failed summary keeps its last run time,
+        so that its retry, after RETRY_DELAY, covers the same messages.
+        """
+        while True:
+            self._changed.clear()
+            if not self.active:
+                await self._changed.wait()
+                continue
+            summary, due = self.next_run()
+            delay = (due - datetime.now(timezone.utc)).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                    # Activated or deactivated while waiting.
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            time_now = time.time()
+            if await callback(summary, self._last_run_time(summary)):
+                self.retry_at.pop(summary.key, None)
+                self.set_last_run(summary.key, time_now)
+            else:
+                self.retry_at[summary.key] = datetime.now(timezone.utc) + timedelta(
+                    seconds=RETRY_DELAY
+                )
+
+    def _last_run_time(self, summary: ScheduledSummary) -> datetime:
+        if summary.key in self.last_runs:
+            return datetime.fromtimestamp(self.last_runs[summary.key], timezone.utc)
+        # Never run: cover one period of the schedule.
+        now = datetime.now(timezone.utc)
+        next_run = summary.schedule.next_after(now)
+        return now - (summary.schedule.next_after(next_run) - next_run)
+
+    def _next_run_time(self, summary: ScheduledSummary) -> datetime:
+        if summary.key in self.retry_at:
+            return self.retry_at[summary.key]
+        if summary.key in self.last_runs:
+            return summary.schedule.next_after(self._last_run_time(summary))
+        # Never run: interval schedules are due immediately, cron schedules at their next time.
+        now = datetime.now(timezone.utc)
+        if isinstance(summary.schedule, IntervalSchedule):
+            return now
+        return summary.schedule.next_after(now)
+
+    def _save(self) -> None:
+        if not self.state_path:
+            return
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"active": self.active, "last_runs": self.last_runs}, f)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,62 @@
+import threading
+import time
+from typing import Dict, List
+
+from .summarizer import load_encoding
+
+
+class StartupTimer:
+    """
+    Records how long each phase of startup takes, from when this module is imported until the bot
+    is first ready.
+    """
+
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self._marked_at = self.started_at
+        self.phases: Dict[str, float] = {}
+        self.reported = False
+
+    def mark(self, phase: str) -> None:
+        """
+        Records the time since the previous mark as phase.
+        """
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self._marked_at
+        self._marked_at = now
+
+    def report(self) -> None:
+        """
+        Prints the time taken by each phase, the first time it is called.
+        """
+        if self.reported:
+            return
+        self.reported = True
+        phases = " ".join(
+            f"{phase}={seconds:.2f}s" for phase, seconds in self.phases.items()
+        )
+        print(
+            f"Startup took total={time.perf_counter() - self.started_at:.2f}s {phases}"
+        )
+
+
+STARTUP = StartupTimer()
+
+
+def prewarm_encodings(models: List[str]) -> threading.Thread:
+    """
+    Loads the encodings of models in a background thread, so that loading them, which may mean
+    downloading them the first time, overlaps with the rest of startup.
+    """
+
+    def load() -> None:
+        for model in models:
+            try:
+                load_encoding(model)
+            except Exception as e:
+                # Loading is retried, and the error raised, when the encoding is first used.
+                print(f"Failed to prewarm encoding for model={model}: {e!r}")
+
+    thread = threading.Thread(target=load, name="prewarm-encodings", daemon=True)
+    thread.start()
+    return thread
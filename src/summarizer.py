@@ -1,9 +1,59 @@
 import abc
-from typing import List
+import asyncio
+import hashlib
+import json
+from typing import AsyncIterator, Collection, List, Optional
 
 import tiktoken
 
-from .config import AIConfig
+from .config import AIConfig, PreprocessStep, SummaryMode
+
+# Used for models that tiktoken doesn't know.
+DEFAULT_ENCODING = "cl100k_base"
+
+
+def load_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the encoding used by model. tiktoken loads each encoding once and shares it, so this is
+    cheap once the encoding has been loaded, e.g. by prewarm_encodings.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def fingerprint(
+    config: AIConfig,
+    preprocess_steps: Collection[PreprocessStep],
+    mode: Optional[SummaryMode] = None,
+) -> str:
+    """
+    Identifies the settings that affect summaries, and mode if given, so that changing them
+    re-summarizes messages that were summarized before.
+    """
+    settings = [
+        config.model,
+        config.models,
+        config.routing_policy.value,
+        config.prompt,
+        config.combine_prompt,
+        config.max_output_tokens,
+        [step.value for step in preprocess_steps],
+    ]
+    if mode is not None:
+        settings.append(mode.value)
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+
+
+class RateLimited(Exception):
+    """
+    Raised by Summarizers when the AI provider rejects a request due to rate limits.
+    """
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__(f"Rate limited, retry_after={retry_after}")
+        self.retry_after = retry_after
 
 
 class Summarizer(abc.ABC):
@@ -14,5 +64,80 @@ class Summarizer(abc.ABC):
         self.config = config
 
     @abc.abstractmethod
-    async def summarize(self, messages: List[str]) -> str:
+    async def summarize(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> str:
+        """
+        Summarizes messages using prompt, which defaults to self.config.prompt. num_tokens is the
+        number of tokens in messages, if already known.
+        """
         pass
+
+    async def summarize_stream(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        """
+        As summarize, but yields the summary in pieces as it is generated. Summarizers that do not
+        support streaming yield the whole summary at once.
+        """
+        yield await self.summarize(messages, prompt, num_tokens)
+
+    def model_for(self, messages: List[str], num_tokens: Optional[int] = None) -> str:
+        """
+        Returns the model that a request to summarize messages is sent to.
+        """
+        return self.config.model
+
+    async def summarize_many(
+        self,
+        requests: List[List[str]],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[List[int]] = None,
+    ) -> List[str]:
+        """
+        Summarizes each list of messages in requests, as summarize, returning the summaries in the
+        same order. Summarizers may send the requests together, trading latency for cost.
+        """
+        request_tokens: List[Optional[int]] = (
+            list(num_tokens) if num_tokens else [None] * len(requests)
+        )
+        return await asyncio.gather(
+            *(
+                self.summarize(messages, prompt, tokens)
+                for messages, tokens in zip(requests, request_tokens)
+            )
+        )
+
+    async def combine(self, summaries: List[str]) -> str:
+        """
+        Merges summaries of consecutive parts of a conversation into a single summary. Summaries are
+        packed into groups that fit within self.max_msg_tokens, each group is summarized in parallel,
+        and the process repeats on the results until one summary remains.
+        """
+        while len(summaries) > 1:
+            groups: List[List[str]] = [[]]
+            group_tokens = [0]
+            texts = [f"{summary}\n\n" for summary in summaries]
+            for text, tokens in zip(texts, self.encoding.encode_ordinary_batch(texts)):
+                if group_tokens[-1] + len(tokens) > self.max_msg_tokens:
+                    groups.append([])
+                    group_tokens.append(0)
+                groups[-1].append(text)
+                group_tokens[-1] += len(tokens)
+            if len(groups) == len(summaries):
+                raise Exception(
+                    f"Summaries too long to combine: max_msg_tokens={self.max_msg_tokens}"
+                )
+            summaries = await asyncio.gather(
+                *(
+                    self.summarize(group, self.config.combine_prompt, tokens)
+                    for group, tokens in zip(groups, group_tokens)
+                )
+            )
+        return summaries[0]
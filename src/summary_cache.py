@@ -0,0 +1,169 @@
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional
+
+from . import metrics
+from .summarizer import Summarizer
+
+
+class SummaryCache:
+    """
+    Least-recently-used cache of summaries, optionally persisted to a SQLite file so that it survives
+    restarts. Entries older than ttl seconds are treated as missing.
+    """
+
+    def __init__(
+        self, max_size: int, ttl: Optional[float] = None, path: Optional[str] = None
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (summary, time the summary was stored)
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.db = sqlite3.connect(path) if path else None
+        if self.db is not None:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS summaries (
+                    key TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None and self.db is not None:
+            row = self.db.execute(
+                "SELECT summary, created_at FROM summaries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                entry = (row[0], row[1])
+                self._remember(key, entry)
+        if entry is None or self._expired(entry[1]):
+            self._entries.pop(key, None)
+            self.misses += 1
+            metrics.CACHE_LOOKUPS.inc(1, "miss")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        metrics.CACHE_LOOKUPS.inc(1, "hit")
+        return entry[0]
+
+    def put(self, key: str, summary: str) -> None:
+        entry = (summary, time.time())
+        self._remember(key, entry)
+        if self.db is not None:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)", (key, *entry)
+                )
+                self.db.execute(
+                    """
+                    DELETE FROM summaries WHERE key NOT IN (
+                        SELECT key FROM summaries ORDER BY created_at DESC LIMIT ?
+                    ) OR created_at < ?
+                    """,
+                    (self.max_size, entry[1] - self.ttl if self.ttl else 0),
+                )
+
+    def _remember(self, key: str, entry: tuple[str, float]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+
+class CachedSummarizer(Summarizer):
+    """
+    Wraps a Summarizer so that identical requests - same model, prompt, output limit and messages -
+    are only sent to the AI provider once.
+    """
+
+    def __init__(self, summarizer: Summarizer, cache: SummaryCache):
+        Summarizer.__init__(self, summarizer.config)
+        self.summarizer = summarizer
+        self.encoding = summarizer.encoding
+        self.max_msg_tokens = summarizer.max_msg_tokens
+        self.cache = cache
+
+    async def summarize(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> str:
+        key = self.cache_key(messages, prompt or self.config.prompt, num_tokens)
+        if (summary := self.cache.get(key)) is not None:
+            return summary
+        summary = await self.summarizer.summarize(messages, prompt, num_tokens)
+        self.cache.put(key, summary)
+        return summary
+
+    def model_for(self, messages: List[str], num_tokens: Optional[int] = None) -> str:
+        return self.summarizer.model_for(messages, num_tokens)
+
+    async def summarize_stream(
+        self,
+        messages: List[str],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[int] = None,
+    ) -> AsyncIterator[str]:
+        key = self.cache_key(messages, prompt or self.config.prompt, num_tokens)
+        if (summary := self.cache.get(key)) is not None:
+            yield summary
+            return
+        pieces: List[str] = []
+        async for piece in self.summarizer.summarize_stream(
+            messages, prompt, num_tokens
+        ):
+            pieces.append(piece)
+            yield piece
+        self.cache.put(key, "".join(pieces))
+
+    async def summarize_many(
+        self,
+        requests: List[List[str]],
+        prompt: Optional[str] = None,
+        num_tokens: Optional[List[int]] = None,
+    ) -> List[str]:
+        keys = [
+            self.cache_key(
+                messages,
+                prompt or self.config.prompt,
+                num_tokens[i] if num_tokens else None,
+            )
+            for i, messages in enumerate(requests)
+        ]
+        summaries = [self.cache.get(key) for key in keys]
+        # Only send the requests that missed the cache.
+        misses = [i for i, summary in enumerate(summaries) if summary is None]
+        if misses:
+            results = await self.summarizer.summarize_many(
+                [requests[i] for i in misses],
+                prompt,
+                [num_tokens[i] for i in misses] if num_tokens else None,
+            )
+            for i, summary in zip(misses, results):
+                self.cache.put(keys[i], summary)
+                summaries[i] = summary
+        return [summary for summary in summaries if summary is not None]
+
+    def cache_key(
+        self, messages: List[str], prompt: str, num_tokens: Optional[int] = None
+    ) -> str:
+        request = [
+            self.summarizer.model_for(messages, num_tokens),
+            prompt,
+            self.config.max_output_tokens,
+            messages,
+        ]
+        return hashlib.sha256(json.dumps(request).encode()).hexdigest()
@@ -0,0 +1,60 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+import tiktoken
+
+from .messages import ChannelMessage
+
+# Below this many messages, tokenizing in a thread costs more than it saves.
+MIN_OFF_LOOP_MESSAGES = 32
+
+
+class TokenCounter:
+    """
+    Counts tokens in formatted messages. Counts are memoized per message, keyed by message id, edit
+    time and a hash of the formatted message (which may vary, e.g. with preprocessing), so that
+    messages seen by an earlier summary are not tokenized again. Uncached
+    messages are tokenized in a thread pool to keep the event loop responsive.
+    """
+
+    def __init__(
+        self, encoding: tiktoken.Encoding, max_size: int, num_threads: int = 2
+    ):
+        self.encoding = encoding
+        self.max_size = max_size
+        # (message id, edit time, hash of formatted message) -> token count
+        self._counts: OrderedDict[
+            tuple[int, Optional[datetime], int], int
+        ] = OrderedDict()
+        self._executor = ThreadPoolExecutor(num_threads, thread_name_prefix="tokenizer")
+
+    async def count(
+        self, messages: List[ChannelMessage], formatted_msgs: List[str]
+    ) -> List[int]:
+        counts = [0] * len(messages)
+        misses: List[int] = []
+        for i, (msg, formatted_msg) in enumerate(zip(messages, formatted_msgs)):
+            key = (msg.id, msg.edited_at, hash(formatted_msg))
+            if (count := self._counts.get(key)) is not None:
+                self._counts.move_to_end(key)
+                counts[i] = count
+            else:
+                misses.append(i)
+        if misses:
+            texts = [formatted_msgs[i] for i in misses]
+            if len(texts) < MIN_OFF_LOOP_MESSAGES:
+                tokens = self.encoding.encode_ordinary_batch(texts)
+            else:
+                tokens = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self.encoding.encode_ordinary_batch, texts
+                )
+            for i, text, msg_tokens in zip(misses, texts, tokens):
+                msg = messages[i]
+                counts[i] = len(msg_tokens)
+                self._counts[(msg.id, msg.edited_at, hash(text))] = len(msg_tokens)
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+        return counts
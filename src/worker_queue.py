@@ -0,0 +1,353 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import AsyncIterator, Collection, Iterator, List, Optional, Tuple
+
+from .config import AIConfig, PreprocessStep
+from .messages import ChannelMessage, message_from_dict, message_to_dict
+from .openai_utils import SummaryClient
+from .pipeline import SummaryPipeline
+from .rate_limiter import RateLimitedSummarizer, scaled_limit
+from .summarizer import Summarizer
+
+# Seconds between checks for a new job, or for a job's result.
+POLL_INTERVAL = 0.5
+
+# Seconds between a worker's heartbeats while it runs a job. A running job without a heartbeat for
+# STALE_AFTER seconds is assumed to belong to a worker that died, and is queued again.
+HEARTBEAT_INTERVAL = 10
+STALE_AFTER = 60
+
+# Summarizes a channel's messages, added to the job in pages, returning a summary per batch, or one
+# combined summary.
+CHANNEL_JOB = "channel"
+# Combines summaries into one.
+COMBINE_JOB = "combine"
+
+
+class WorkerQueue:
+    """
+    Queue of summary jobs in a SQLite database shared between the bot, which enqueues jobs and waits
+    for their results, and worker processes on the same machine, which run them.
+
+    Calls may block while another process writes, so the bot makes them with asyncio.to_thread, and
+    they may be made from any thread.
+    """
+
+    def __init__(self, path: str):
+        # Wait for other processes' transactions to finish rather than failing.
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # Stops transactions from different threads interleaving on the one connection.
+        self.lock = threading.Lock()
+        # Lets the bot and workers read while another process writes.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                -- pending, while pages are being added, then queued, running, done or failed.
+                status TEXT NOT NULL,
+                result TEXT,
+                enqueued_at REAL NOT NULL,
+                heartbeat_at REAL,
+                worker TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, id);
+            -- Messages of channel jobs, in order of id.
+            CREATE TABLE IF NOT EXISTS job_pages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER NOT NULL,
+                messages TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS job_pages_by_job ON job_pages (job_id, id);
+            -- Running worker processes, which share the workers' part of the rate limits.
+            CREATE TABLE IF NOT EXISTS workers (
+                name TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL
+            );
+            """
+        )
+
+    def enqueue(self, kind: str, payload: dict, pending: bool = False) -> int:
+        """
+        Adds a job, returning its id. A pending job is not run until submitted, so that pages of
+        messages can be added to it first.
+        """
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (kind, payload, status, enqueued_at) VALUES (?, ?, ?, ?)",
+                (
+                    kind,
+                    json.dumps(payload),
+                    "pending" if pending else "queued",
+                    time.time(),
+                ),
+            )
+        assert cursor.lastrowid is not None
+        return cursor.lastrowid
+
+    def add_page(self, job_id: int, messages: List[ChannelMessage]) -> None:
+        page = json.dumps([message_to_dict(msg) for msg in messages])
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO job_pages (job_id, messages) VALUES (?, ?)",
+                (job_id, page),
+            )
+
+    def submit(self, job_id: int) -> None:
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = 'queued', enqueued_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+
+    def pages(self, job_id: int) -> Iterator[List[ChannelMessage]]:
+        """
+        Yields the job's pages of messages, reading one page at a time.
+        """
+        page_id = 0
+        while True:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT id, messages FROM job_pages WHERE job_id = ? AND id > ? ORDER BY id LIMIT 1",
+                    (job_id, page_id),
+                ).fetchone()
+            if row is None:
+                return
+            page_id = row[0]
+            yield [message_from_dict(msg) for msg in json.loads(row[1])]
+
+    def delete(self, job_id: int) -> None:
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.db.execute("DELETE FROM job_pages WHERE job_id = ?", (job_id,))
+
+    def claim(self, worker: str) -> Optional[Tuple[int, str, dict]]:
+        """
+        Marks the oldest queued job as run by worker, returning its id, kind and payload, or None if
+        no jobs are queued.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat_at < ?",
+                (now - STALE_AFTER,),
+            )
+            # A single statement, so that two workers cannot claim the same job.
+            row = self.db.execute(
+                "UPDATE jobs SET status = 'running', heartbeat_at = ?, worker = ? WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1) RETURNING id, kind, payload",
+                (now, worker),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def heartbeat(self, job_id: int) -> None:
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time(), job_id)
+            )
+
+    def finish(self, job_id: int, result: dict) -> None:
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = 'done', result = ? WHERE id = ? AND status = 'running'",
+                (json.dumps(result), job_id),
+            )
+
+    def fail(self, job_id: int, error: str) -> None:
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = 'failed', result = ? WHERE id = ? AND status = 'running'",
+                (json.dumps({"error": error}), job_id),
+            )
+
+    def status(self, job_id: int) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Returns the job's status and result, or None if it is no longer queued.
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT status, result FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+
+    async def result(self, job_id: int) -> dict:
+        """
+        Waits for the job to finish, then removes it from the queue and returns its result. Raises
+        if the job failed. The database is only read off the event loop.
+        """
+        while True:
+            row = await asyncio.to_thread(self.status, job_id)
+            if row is None:
+                raise Exception(f"Job {job_id} is no longer queued.")
+            status, result = row
+            if status in ("done", "failed"):
+                await asyncio.to_thread(self.delete, job_id)
+                assert result is not None
+                decoded = json.loads(result)
+                if status == "failed":
+                    raise Exception(f"Job {job_id} failed: {decoded['error']}")
+                return decoded
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def register(self, worker: str) -> int:
+        """
+        Records that worker is running, returning how many workers are running, including workers
+        started separately. Workers re-register every HEARTBEAT_INTERVAL seconds, and are no
+        longer counted STALE_AFTER seconds after they stop.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM workers WHERE heartbeat_at < ?", (now - STALE_AFTER,)
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker, now)
+            )
+            (count,) = self.db.execute("SELECT COUNT(*) FROM workers").fetchone()
+        return count
+
+    def unregister(self, worker: str) -> None:
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM workers WHERE name = ?", (worker,))
+
+    def clear(self) -> None:
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM jobs")
+            self.db.execute("DELETE FROM job_pages")
+
+
+def channel_job(
+    preprocess_steps: Collection[PreprocessStep], concurrency: int, combine: bool
+) -> dict:
+    """
+    Returns the payload of a job summarizing the messages from one channel added to it. If combine
+    is set, the summaries of the channel's batches are combined into one.
+    """
+    return {
+        "preprocess_steps": [step.value for step in preprocess_steps],
+        "concurrency": concurrency,
+        "combine": combine,
+    }
+
+
+async def run_job(
+    queue: WorkerQueue, summarizer: Summarizer, job_id: int, kind: str, payload: dict
+) -> dict:
+    if kind == COMBINE_JOB:
+        return {"summary": await summarizer.combine(payload["summaries"])}
+    if kind != CHANNEL_JOB:
+        raise Exception(f"Unknown job kind {kind}")
+
+    async def history() -> AsyncIterator[ChannelMessage]:
+        for page in queue.pages(job_id):
+            for msg in page:
+                yield msg
+
+    pipeline = SummaryPipeline(
+        summarizer,
+        concurrency=payload["concurrency"],
+        preprocess_steps=[PreprocessStep(step) for step in payload["preprocess_steps"]],
+    )
+    batches = []
+    summaries: List[str] = []
+    async for batch, summary in pipeline.summarized_batches(history()):
+        batches.append(
+            {
+                "first_id": batch.first_id,
+                "last_id": batch.last_id,
+                "next_id": batch.next_id,
+                "summary": summary,
+            }
+        )
+        summaries.append(summary)
+    if payload["combine"] and len(summaries) > 1:
+        summaries = [await summarizer.combine(summaries)]
+    return {"batches": batches, "summaries": summaries}
+
+
+def worker_summarizer(config: AIConfig) -> RateLimitedSummarizer:
+    """
+    Returns a summarizer for a worker process, with the full rate limits until its share is set
+    with share_limits.
+    """
+    return RateLimitedSummarizer(
+        SummaryClient(config, api_key=config.api_key),
+        config.requests_per_minute,
+        config.tokens_per_minute,
+    )
+
+
+def share_limits(summarizer: RateLimitedSummarizer, workers: int) -> None:
+    """
+    Limits summarizer to its part of config.worker_rate_limit_share of the rate limits, split
+    evenly between workers workers.
+    """
+    config = summarizer.config
+    share = config.worker_rate_limit_share / workers
+    summarizer.set_limits(
+        scaled_limit(config.requests_per_minute, share),
+        scaled_limit(config.tokens_per_minute, share),
+    )
+
+
+async def run_worker(
+    queue: WorkerQueue, summarizer: RateLimitedSummarizer, concurrency: int
+) -> None:
+    """
+    Runs jobs from queue forever, up to concurrency at a time. The workers using queue share
+    summarizer.config.worker_rate_limit_share of the rate limits, leaving the rest to the bot.
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def keep_registered(workers: int) -> None:
+        # Workers starting or stopping change each worker's share within HEARTBEAT_INTERVAL.
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if (count := queue.register(worker)) != workers:
+                workers = count
+                share_limits(summarizer, workers)
+                print(f"Sharing rate limits workers={workers}")
+
+    async def keep_alive(job_id: int) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            queue.heartbeat(job_id)
+
+    async def work() -> None:
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            job_id, kind, payload = claimed
+            started_at = time.monotonic()
+            heartbeat = asyncio.create_task(keep_alive(job_id))
+            try:
+                result = await run_job(queue, summarizer, job_id, kind, payload)
+            except Exception as e:
+                print(f"Job failed id={job_id} kind={kind}: {e!r}")
+                queue.fail(job_id, repr(e))
+                continue
+            finally:
+                heartbeat.cancel()
+            queue.finish(job_id, result)
+            print(
+                f"Job done id={job_id} kind={kind} run={time.monotonic() - started_at:.1f}s"
+            )
+
+    workers = queue.register(worker)
+    share_limits(summarizer, workers)
+    print(f"Worker started worker={worker} concurrency={concurrency} workers={workers}")
+    try:
+        await asyncio.gather(
+            keep_registered(workers), *(work() for _ in range(concurrency))
+        )
+    finally:
+        queue.unregister(worker)
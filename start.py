@@ -1,26 +1,29 @@
-from dataclasses import dataclass
-from datetime import datetime
+# Imported first so that startup is timed from here, and so that the AI model's encoding loads in
+# the background while the rest is imported.
+from src.startup import STARTUP, prewarm_encodings  # isort: skip
+from src.config import load_config  # isort: skip
+
+discord_config, ai_config = load_config()
+STARTUP.mark("config")
+prewarm_encodings([ai_config.model])
 
 from discord import Intents
+from openai import AsyncOpenAI
 
-from src.config import AIProvider, load_config
+from src.batch_api import (
+    BatchBackend,
+    BatchJobSummarizer,
+    LocalBatchBackend,
+    OpenAIBatchBackend,
+)
+from src.config import AIProvider, BatchAPI, WorkerMode
 from src.discord_client import DiscordClient, register_commands
 from src.openai_utils import SummaryClient as OpenAISummaryClient
+from src.rate_limiter import RateLimitedSummarizer, scaled_limit
 from src.summarizer import Summarizer
+from src.summary_cache import CachedSummarizer, SummaryCache
 
-
-@dataclass(frozen=True)
-class ChannelInfo:
-    name: str
-    id: int
-
-
-@dataclass
-class ChannelMessage:
-    author: str
-    content: str
-    channel: ChannelInfo
-    timestamp: datetime
+STARTUP.mark("imports")
 
 
 def ai_client(ai_provider: AIProvider) -> type[Summarizer]:
@@ -28,17 +31,71 @@ def ai_client(ai_provider: AIProvider) -> type[Summarizer]:
         return OpenAISummaryClient
 
 
-discord_config, ai_config = load_config()
+# OpenAI client. This waits for the encoding to finish loading.
+ai_summarizer = ai_client(ai_config.provider)(ai_config, api_key=ai_config.api_key)
+STARTUP.mark("encoding")
+# With worker processes, the bot only summarizes /tldr requests, and leaves the workers their
+# share of the rate limits.
+bot_rate_limit_share = (
+    1 - ai_config.worker_rate_limit_share
+    if discord_config.worker_mode is WorkerMode.queue
+    else 1
+)
+rate_limited_summarizer = RateLimitedSummarizer(
+    ai_summarizer,
+    scaled_limit(ai_config.requests_per_minute, bot_rate_limit_share),
+    scaled_limit(ai_config.tokens_per_minute, bot_rate_limit_share),
+)
+summary_cache = (
+    SummaryCache(
+        ai_config.summary_cache_size,
+        ai_config.summary_cache_ttl,
+        ai_config.summary_cache_path,
+    )
+    if ai_config.summary_cache_size > 0
+    else None
+)
+
+
+def cached(summarizer: Summarizer) -> Summarizer:
+    if summary_cache is None:
+        return summarizer
+    return CachedSummarizer(summarizer, summary_cache)
+
+
+summarizer = cached(rate_limited_summarizer)
 
-# OpenAI client
-summarizer = ai_client(ai_config.provider)(ai_config, api_key=ai_config.api_key)
+# Periodic summaries can be sent as batch jobs, away from the rate limits of interactive requests.
+periodic_summarizer = None
+if ai_config.batch_api is not None:
+    batch_backend: BatchBackend
+    if ai_config.batch_api is BatchAPI.open_ai:
+        if not isinstance(ai_summarizer, AsyncOpenAI):
+            raise Exception("BATCH_API=open_ai requires AI_PROVIDER=open_ai")
+        batch_backend = OpenAIBatchBackend(ai_summarizer)
+    else:
+        batch_backend = LocalBatchBackend(rate_limited_summarizer)
+    periodic_summarizer = cached(
+        BatchJobSummarizer(
+            rate_limited_summarizer,
+            batch_backend,
+            ai_config.batch_api_path,
+            ai_config.batch_api_poll_interval,
+        )
+    )
 
 intents = Intents.default()
 intents.message_content = True
 intents.messages = True
 intents.guild_messages = True
 intents.guild_reactions = True
-client = DiscordClient(discord_config, summarizer, intents=intents)
+client = DiscordClient(
+    discord_config,
+    summarizer,
+    periodic_summarizer=periodic_summarizer,
+    intents=intents,
+)
 register_commands(client)
+STARTUP.mark("client")
 # TODO: run this in such a way that Exception cause the process to terminate
 client.run(discord_config.client_key)
@@ -0,0 +1,56 @@
+"""
+Runs the summary jobs queued by the bot when SUMMARY_WORKER_MODE is queue. Run as many workers as
+needed on the same machine as the bot, sharing its JOB_QUEUE_PATH.
+"""
+
+import argparse
+import asyncio
+import os
+from multiprocessing import Process
+
+from src.config import AIConfig, load_ai_config
+from src.worker_queue import WorkerQueue, run_worker, worker_summarizer
+
+
+def run(config: AIConfig, queue_path: str, concurrency: int) -> None:
+    # run_worker limits the summarizer to this process's share of the rate limits.
+    asyncio.run(
+        run_worker(WorkerQueue(queue_path), worker_summarizer(config), concurrency)
+    )
+
+
+def main() -> None:
+    # Loaded first so that ENV_FILE applies to the defaults below.
+    config = load_ai_config()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--queue",
+        default=os.getenv("JOB_QUEUE_PATH", "jobs.db"),
+        help="as JOB_QUEUE_PATH",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="worker processes, which share WORKER_RATE_LIMIT_SHARE of the AI rate limits with all other workers",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="jobs at once per worker process"
+    )
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run(config, args.queue, args.concurrency)
+        return
+    workers = [
+        Process(target=run, args=(config, args.queue, args.concurrency))
+        for _ in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()